@@ -112,6 +112,9 @@ start_ofw:
 #if ENABLE_SMB1_GRAPHIC_MODS
 #define SMB1_GRAPHIC_MODS_MAX 8
 const uint8_t * const SMB1_GRAPHIC_MODS[SMB1_GRAPHIC_MODS_MAX] = { 0 };
+#define SMB1_CHR_OFFSET 0x8000
+#define SMB1_CHR_SIZE 0x1ec0
+static const char SMB1_CHR_XOR_HEADER[] = {'X', 'C', 'H', 'R'};
 static volatile uint8_t smb1_graphics_idx = 0;
 
 uint8_t * prepare_clock_rom(void *mario_rom, size_t len){
@@ -128,9 +131,17 @@ uint8_t * prepare_clock_rom(void *mario_rom, size_t len){
 
     if(patch) {
         // Load custom graphics
-        if(IPS_PATCH_WRONG_HEADER == ips_patch(smb1_clock_working, patch)){
+        if(!memcmp(patch, SMB1_CHR_XOR_HEADER, sizeof(SMB1_CHR_XOR_HEADER))){
+            // Compressed XOR delta against the ROM's graphics
+            const uint8_t *stock = (const uint8_t *)mario_rom + SMB1_CHR_OFFSET;
+            memcpy_inflate(smb1_clock_graphics_working, patch + sizeof(SMB1_CHR_XOR_HEADER), SMB1_CHR_SIZE);
+            for(size_t i = 0; i < SMB1_CHR_SIZE; i++){
+                smb1_clock_graphics_working[i] ^= stock[i];
+            }
+        }
+        else if(IPS_PATCH_WRONG_HEADER == ips_patch(smb1_clock_working, patch)){
             // Attempt a direct graphics override
-            memcpy_inflate(smb1_clock_graphics_working, patch, 0x1ec0);
+            memcpy_inflate(smb1_clock_graphics_working, patch, SMB1_CHR_SIZE);
         }
     }
     else{
@@ -16,13 +16,21 @@ import colorama
 from colorama import Fore, Style
 
 from patches import Device
+from patches.artifacts import DEFAULT_GROUPS, GROUPS, parse_groups
 from patches.exception import InvalidPatchError
 
-colorama.init()
+
+def _artifact_groups(string):
+    try:
+        return parse_groups(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Game and Watch Firmware Patcher.")
+    parser = argparse.ArgumentParser(
+        description="Game and Watch Firmware Patcher.", add_help=False
+    )
 
     #########################
     # Global configurations #
@@ -49,6 +57,11 @@ def main():
         default="build/gw_patch.elf",
         help="ELF file corresponding to the bin provided by --patch",
     )
+    parser.add_argument(
+        "--patch-from-elf",
+        action="store_true",
+        help="Load the novel code from the loadable segments of --elf instead of --patch.",
+    )
     parser.add_argument(
         "--int-output",
         type=Path,
@@ -93,6 +106,28 @@ def main():
         "flash.",
     )
 
+    parser.add_argument(
+        "--no-recompress-images",
+        action="store_true",
+        help="Keep the stock encoding of the sleep/backdrop images instead of "
+        "re-encoding them smaller.",
+    )
+
+    parser.add_argument(
+        "--artifacts",
+        type=_artifact_groups,
+        default=",".join(DEFAULT_GROUPS),
+        metavar="GROUPS",
+        help="Comma separated debugging/development files to write to build/: "
+        + " ".join(f"{k}: {v}" for k, v in GROUPS.items())
+        + ' Also "all" or "none". Default: %(default)s.',
+    )
+    parser.add_argument(
+        "--rebuild-stock-cache",
+        action="store_true",
+        help="Ignore and regenerate the cached decrypted/decompressed stock firmware.",
+    )
+
     debugging = parser.add_argument_group("Debugging")
     debugging.add_argument(
         "--show",
@@ -102,47 +137,78 @@ def main():
     debugging.add_argument(
         "--debug", action="store_true", help="Install useful debugging fault handlers."
     )
+    debugging.add_argument(
+        "--owner",
+        type=lambda x: int(x, 0),
+        action="append",
+        default=[],
+        metavar="ADDRESS",
+        help="Print which patch last wrote to this absolute address. May be repeated.",
+    )
 
-    args, _ = parser.parse_known_args()
+    # Phase 1: Fully parse and validate arguments; no firmware is loaded yet.
+    # Help is added after ``--device`` is known so that it also lists the
+    # device-specific options.
+    known, _ = parser.parse_known_args()
+    parser.add_argument(
+        "-h", "--help", action="help", help="show this help message and exit"
+    )
+    device_cls = Device.registry[known.device]
+    args = device_cls.argparse(parser)
     args.int_firmware = Path(f"internal_flash_backup_{args.device}.bin")
     args.ext_firmware = Path(f"flash_backup_{args.device}.bin")
 
-    device = Device.registry[args.device](
-        args.int_firmware, args.elf, args.ext_firmware
+    # Phase 2: Load the firmware.
+    from patches.cache import StockCache
+
+    colorama.init()
+
+    stock_cache = StockCache(rebuild=args.rebuild_stock_cache)
+    device = device_cls(
+        args.int_firmware,
+        args.elf,
+        args.ext_firmware,
+        stock_cache=stock_cache,
+        args=args,
     )
-    args = device.argparse(parser)
-    device.crypt()  # Decrypt the external firmware
 
     # Save the decrypted external firmware for debugging/development purposes.
-    Path("build/decrypt.bin").write_bytes(device.external)
+    device.dump("build/decrypt.bin", lambda: device.external, group="debug")
 
     # Dump ITCM and DTCM RAM data
     if (
         device.internal.RWDATA_OFFSET is not None
         and device.internal.RWDATA_ITCM_IDX is not None
     ):
-        Path("build/itcm_rwdata.bin").write_bytes(
-            device.internal.rwdata.datas[device.internal.RWDATA_ITCM_IDX]
+        device.dump(
+            "build/itcm_rwdata.bin",
+            lambda: device.internal.rwdata.datas[device.internal.RWDATA_ITCM_IDX],
+            group="debug",
         )
     if (
         device.internal.RWDATA_OFFSET is not None
         and device.internal.RWDATA_DTCM_IDX is not None
     ):
-        Path("build/dtcm_rwdata.bin").write_bytes(
-            device.internal.rwdata.datas[device.internal.RWDATA_DTCM_IDX]
+        device.dump(
+            "build/dtcm_rwdata.bin",
+            lambda: device.internal.rwdata.datas[device.internal.RWDATA_DTCM_IDX],
+            group="debug",
         )
 
     # Copy over novel code
-    patch = args.patch.read_bytes()
-    if len(device.internal) != len(patch):
-        raise InvalidPatchError(
-            f"Expected patch length {len(device.internal)}, got {len(patch)}"
-        )
+    if args.patch_from_elf:
+        device.internal.load_elf(args.elf)
+    else:
+        patch = args.patch.read_bytes()
+        if len(device.internal) != len(patch):
+            raise InvalidPatchError(
+                f"Expected patch length {len(device.internal)}, got {len(patch)}"
+            )
 
-    # novel_code_start = device.internal.address("__do_global_dtors_aux") & 0x00FF_FFF8
-    novel_code_start = device.internal.STOCK_ROM_END
-    device.internal[novel_code_start:] = patch[novel_code_start:]
-    del patch
+        # novel_code_start = device.internal.address("__do_global_dtors_aux") & 0x00FF_FFF8
+        novel_code_start = device.internal.STOCK_ROM_END
+        device.internal[novel_code_start:] = patch[novel_code_start:]
+        del patch
 
     if args.sd_bootloader:
         device.internal.extend(b"\x00" * 0x12000)
@@ -159,18 +225,27 @@ def main():
         compressed_memory_remaining_free,
     ) = device()  # Apply patches
 
+    for address in args.owner:
+        print(f"Owner of 0x{address:08X}: {device.owner(address) or 'unpatched'}")
+
     if args.show:
         # Debug visualization
         device.show()
 
     # Re-encrypt the external firmware
-    Path("build/decrypt_flash_patched.bin").write_bytes(device.external)
+    device.dump(
+        "build/decrypt_flash_patched.bin",
+        lambda: device.external,
+        group="debug",
+        stock=False,
+    )
     if args.encrypt:
         device.external.crypt(device.internal.key, device.internal.nonce)
 
     # Save patched firmware
     args.int_output.write_bytes(device.internal)
     args.ext_output.write_bytes(device.external)
+    device.artifacts.close()
 
     print(Fore.GREEN)
     print("Binary Patching Complete!")
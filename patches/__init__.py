@@ -1,6 +1,32 @@
+"""The patcher is imported lazily so that light submodules (e.g.
+``patches.devices``) can be imported without pulling in everything else.
+"""
+
+import patches.bps
 import patches.ips
 
-from .compression import lz77_decompress, lzma_compress
-from .firmware import Device, ExtFirmware, Firmware, IntFirmware
-from .mario import MarioGnW
-from .zelda import ZeldaGnW
+_EXPORTS = {
+    "lz77_decompress": ".compression",
+    "lzma_compress": ".compression",
+    "Device": ".firmware",
+    "ExtFirmware": ".firmware",
+    "Firmware": ".firmware",
+    "IntFirmware": ".firmware",
+    "MarioGnW": ".mario",
+    "ZeldaGnW": ".zelda",
+}
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib import import_module
+
+    # Always import all devices so that ``Device.registry`` is populated.
+    import_module(".mario", __name__)
+    import_module(".zelda", __name__)
+
+    value = getattr(import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
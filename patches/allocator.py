@@ -0,0 +1,98 @@
+"""Free-list allocator over a flash image.
+
+The whole image starts out allocated (it's full of stock data); patches
+``free`` the regions they delete or relocate, and data that has to stay in
+the image is re-``allocate``d into the best fitting hole.
+"""
+
+from .exception import NotEnoughSpaceError
+from .intervals import IntervalIndex
+
+_FREE = "free"
+
+
+def _round_up(val, align):
+    return -(-val // align) * align
+
+
+class RegionAllocator:
+    def __init__(self, size):
+        self.size = size
+        self._holes = IntervalIndex()
+
+    def __iter__(self):
+        """Yields ``(start, end)`` of every hole in ascending order."""
+        for start, end, _ in self._holes:
+            yield start, end
+
+    def __repr__(self):
+        holes = ", ".join(f"0x{s:06X}-0x{e:06X}" for s, e in self)
+        return f"{type(self).__name__}(size=0x{self.size:X}, holes=[{holes}])"
+
+    @property
+    def free_space(self):
+        return sum(end - start for start, end in self)
+
+    @property
+    def high_water_mark(self):
+        """End of the last allocated byte."""
+        holes = list(self)
+        if holes and holes[-1][1] == self.size:
+            return holes[-1][0]
+        return self.size
+
+    def is_free(self, offset, size):
+        return any(
+            start <= offset and offset + size <= end
+            for start, end, _ in self._holes.overlapping(offset, offset + size)
+        )
+
+    def free(self, offset, size):
+        """Return ``[offset, offset + size)`` to the free list."""
+        if size <= 0:
+            return
+        if offset < 0 or offset + size > self.size:
+            raise IndexError(
+                f"Region 0x{offset:X}-0x{offset + size:X} exceeds size 0x{self.size:X}"
+            )
+        if self._holes.overlapping(offset, offset + size):
+            raise ValueError(
+                f"Region 0x{offset:X}-0x{offset + size:X} is already (partially) free"
+            )
+        self._holes.add(offset, offset + size, _FREE)
+
+    def allocate(self, size, align=4, limit=None):
+        """Best-fit allocation.
+
+        Parameters
+        ----------
+        align : int
+            Alignment of the returned offset, e.g. ``4096`` for a flash page.
+        limit : int
+            Only consider holes starting at or before ``limit``. Used when
+            relocating data so it never moves towards the end of the image.
+
+        Returns
+        -------
+        int
+            Offset of the allocated region.
+        """
+        best = None
+        for start, end in self:
+            if limit is not None and start > limit:
+                break
+            aligned = _round_up(start, align)
+            if aligned + size > end:
+                continue
+            slack = (end - start) - size
+            if best is None or slack < best[0]:
+                best = (slack, aligned)
+
+        if best is None:
+            raise NotEnoughSpaceError(
+                f"No free region of {size} bytes (alignment {align})"
+            )
+
+        offset = best[1]
+        self._holes.remove(offset, offset + size)
+        return offset
@@ -0,0 +1,94 @@
+"""Background writer for debugging/development artifacts in ``build/``.
+
+Producers are only called for requested artifact groups. Their results are
+encoded (e.g. PNG) and written from a thread pool, so patching never waits
+on image encoding or disk I/O. Files whose content didn't change are left
+untouched.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+
+from .cache import atomic_write_bytes
+
+GROUPS = {
+    "debug": "Decrypted firmware and rwdata, before and after patching.",
+    "roms": "Stock game ROMs, e.g. smb1.nes.",
+    "graphics": "Tilesets, iconset and backdrop images as PNG.",
+}
+DEFAULT_GROUPS = ("roms", "graphics")
+
+
+def parse_groups(string):
+    """Parse ``--artifacts``: comma separated groups, ``all`` or ``none``."""
+    groups = {x.strip() for x in string.split(",") if x.strip()}
+    if groups == {"all"}:
+        return set(GROUPS)
+    if groups == {"none"}:
+        return set()
+    unknown = groups - set(GROUPS)
+    if unknown:
+        raise ValueError(
+            f"Unknown artifact group(s) {', '.join(sorted(unknown))}; "
+            f"choose from {', '.join(GROUPS)}, all, none"
+        )
+    return groups
+
+
+def _encode(path, data):
+    if hasattr(data, "save"):
+        f = BytesIO()
+        data.save(f, format=path.suffix.lstrip(".").upper() or None)
+        return f.getvalue()
+    return data
+
+
+def _write(path, data):
+    """Returns ``False`` if ``path`` already had this content."""
+    data = _encode(path, data)
+    try:
+        if path.stat().st_size == len(data):
+            digest = hashlib.sha1(data).digest()
+            if hashlib.sha1(path.read_bytes()).digest() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+    path.parent.mkdir(exist_ok=True, parents=True)
+    atomic_write_bytes(path, data)
+    return True
+
+
+class ArtifactWriter:
+    def __init__(self, groups=DEFAULT_GROUPS, max_workers=None):
+        self.groups = set(groups)
+        self._max_workers = max_workers
+        self._executor = None
+        self._futures = []
+
+    def wants(self, group):
+        return group in self.groups
+
+    def submit(self, path, data):
+        """Write ``bytes`` or a ``PIL.Image.Image`` to ``path`` in the background."""
+        if not hasattr(data, "save"):
+            # Snapshot; e.g. the firmware keeps being patched.
+            data = bytes(data)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._max_workers)
+        self._futures.append(self._executor.submit(_write, Path(path), data))
+
+    def close(self):
+        """Wait for all pending writes and re-raise the first error.
+
+        Returns
+        -------
+        int
+            Number of files that were (re)written.
+        """
+        futures, self._futures = self._futures, []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        return sum(x.result() for x in futures)
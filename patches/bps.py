@@ -0,0 +1,130 @@
+"""BPS patches.
+
+https://github.com/blakesmith/rombp/blob/master/docs/bps_spec.md
+
+Unlike IPS, a BPS patch records the CRC32 of the source, the target and
+itself, so applying it to the wrong ROM is detected.
+"""
+
+import struct
+import zlib
+from typing import NamedTuple
+
+from .exception import InvalidBPSError
+
+BPS_HEADER = b"BPS1"
+
+SOURCE_READ = 0
+TARGET_READ = 1
+SOURCE_COPY = 2
+TARGET_COPY = 3
+
+_FOOTER = struct.Struct("<III")  # source, target and patch CRC32
+
+
+class BpsHeader(NamedTuple):
+    source_size: int
+    target_size: int
+    metadata: bytes
+    size: int  # Offset of the first action
+
+
+def _read_number(patch, idx):
+    """Decode the variable length number at ``patch[idx]``.
+
+    Returns
+    -------
+    tuple
+        ``(number, idx)`` with ``idx`` past the number.
+    """
+    number, shift = 0, 1
+    while True:
+        if idx >= len(patch):
+            raise InvalidBPSError("Truncated number")
+        byte = patch[idx]
+        idx += 1
+        number += (byte & 0x7F) * shift
+        if byte & 0x80:
+            return number, idx
+        shift <<= 7
+        number += shift
+
+
+def parse_header(patch):
+    patch = memoryview(patch).cast("B")
+    if patch[: len(BPS_HEADER)] != BPS_HEADER:
+        raise InvalidBPSError("Missing BPS1 header")
+    if len(patch) < len(BPS_HEADER) + _FOOTER.size:
+        raise InvalidBPSError("Truncated patch")
+    end = len(patch) - _FOOTER.size
+    source_size, idx = _read_number(patch[:end], len(BPS_HEADER))
+    target_size, idx = _read_number(patch[:end], idx)
+    metadata_size, idx = _read_number(patch[:end], idx)
+    if idx + metadata_size > end:
+        raise InvalidBPSError("Truncated metadata")
+    metadata = bytes(patch[idx : idx + metadata_size])
+    return BpsHeader(source_size, target_size, metadata, idx + metadata_size)
+
+
+def apply(source, patch):
+    """Apply ``patch`` to ``source``, checking all CRCs.
+
+    Returns
+    -------
+    bytearray
+        Patched target.
+    """
+    patch = memoryview(patch).cast("B")
+    header = parse_header(patch)
+    end = len(patch) - _FOOTER.size
+    source_crc, target_crc, patch_crc = _FOOTER.unpack(patch[end:])
+
+    if zlib.crc32(patch[:-4]) != patch_crc:
+        raise InvalidBPSError("Corrupt patch (CRC mismatch)")
+    if len(source) != header.source_size or zlib.crc32(source) != source_crc:
+        raise InvalidBPSError("Patch was made for a different source ROM")
+
+    target = bytearray(header.target_size)
+    actions = patch[:end]
+    idx = header.size
+    out = source_rel = target_rel = 0
+    while idx < end:
+        data, idx = _read_number(actions, idx)
+        command, length = data & 0x3, (data >> 2) + 1
+        if out + length > len(target):
+            raise InvalidBPSError(f"Action at 0x{idx:X} exceeds the target")
+
+        if command == SOURCE_READ:
+            if out + length > len(source):
+                raise InvalidBPSError(f"SourceRead at 0x{idx:X} exceeds the source")
+            target[out : out + length] = source[out : out + length]
+        elif command == TARGET_READ:
+            if idx + length > end:
+                raise InvalidBPSError(f"Truncated TargetRead at 0x{idx:X}")
+            target[out : out + length] = actions[idx : idx + length]
+            idx += length
+        else:
+            delta, idx = _read_number(actions, idx)
+            delta = -(delta >> 1) if delta & 1 else delta >> 1
+            if command == SOURCE_COPY:
+                source_rel += delta
+                if source_rel < 0 or source_rel + length > len(source):
+                    raise InvalidBPSError(f"SourceCopy at 0x{idx:X} out of range")
+                target[out : out + length] = source[source_rel : source_rel + length]
+                source_rel += length
+            else:
+                target_rel += delta
+                if not 0 <= target_rel < out:
+                    raise InvalidBPSError(f"TargetCopy at 0x{idx:X} out of range")
+                # May overlap the output, i.e. repeat the last ``period`` bytes.
+                period = min(out - target_rel, length)
+                chunk = bytes(target[target_rel : target_rel + period])
+                target[out : out + length] = (chunk * -(-length // period))[:length]
+                target_rel += length
+        out += length
+
+    if out != len(target):
+        raise InvalidBPSError("Patch doesn't produce the whole target")
+    if zlib.crc32(target) != target_crc:
+        raise InvalidBPSError("Target CRC mismatch")
+    return target
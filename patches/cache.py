@@ -0,0 +1,159 @@
+"""Persistent cache of deterministic stock firmware preprocessing.
+
+Decrypting the external flash and lz77-decoding the rwdata table only depend
+on the stock dumps, but are slow in pure python. The results are stored in
+``build/stock_cache`` keyed by the full SHA1 of both stock dumps, so only a
+new stock dump (or ``--rebuild-stock-cache``) invalidates them. Entries are
+only stored after the dumps passed the stock hash check, so a hit means the
+same dumps were already verified.
+"""
+
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def atomic_write_bytes(path, data):
+    """Write via a temporary file + rename so readers never see partial data."""
+    path = Path(path)
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive inter-process lock on ``path`` (created if necessary)."""
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with open(path, "a+b") as f:
+        try:
+            import fcntl
+        except ImportError:  # Windows
+            import msvcrt
+
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StockCache:
+    """
+    Files per entry (``<key>`` is ``<device>-<int_sha1>-<ext_sha1>``):
+
+        <key>.internal.bin    Internal firmware after the rwdata table was parsed.
+        <key>.external.bin    Decrypted external firmware.
+        <key>.rwdata.bin      Concatenated lz77-decompressed rwdata blobs.
+        <key>.json            Metadata; written last so partial entries are ignored.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path="build/stock_cache", rebuild=False):
+        self.path = Path(path)
+        self.rebuild = rebuild
+        self.hit = False
+        self.key = None
+        self.meta = None
+
+    def _file(self, suffix):
+        return self.path / f"{self.key}.{suffix}"
+
+    def load(self, device_name, internal_bin, external_bin) -> bool:
+        """Look up the entry for these stock dumps.
+
+        Returns
+        -------
+        bool
+            ``True`` if a valid entry exists and can be restored.
+        """
+        self.key = f"{device_name}-{file_sha1(internal_bin)}-{file_sha1(external_bin)}"
+        self.hit = False
+        self.meta = None
+
+        if self.rebuild:
+            return False
+
+        try:
+            meta = json.loads(self._file("json").read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        if meta.get("version") != self.VERSION:
+            return False
+
+        for suffix in ("internal.bin", "external.bin", "rwdata.bin"):
+            if not self._file(suffix).exists():
+                return False
+
+        self.meta = meta
+        self.hit = True
+        return True
+
+    def file(self, name):
+        """Path of ``internal`` or ``external`` of the loaded entry."""
+        return self._file(f"{name}.bin")
+
+    def rwdata(self):
+        """Restore the decompressed rwdata table.
+
+        Returns
+        -------
+        list
+            List of ``(bytearray, dst)`` tuples.
+        int
+            ``RWData.last_fn``
+        """
+        rwdata = self.meta["rwdata"]
+        elements = []
+        if rwdata["elements"]:
+            blobs = memoryview(self._file("rwdata.bin").read_bytes())
+            for offset, size, dst in rwdata["elements"]:
+                elements.append((bytearray(blobs[offset : offset + size]), dst))
+        return elements, rwdata["last_fn"]
+
+    def store(self, internal, external):
+        """Save freshly preprocessed stock firmware."""
+        self.path.mkdir(exist_ok=True, parents=True)
+
+        elements, blobs, offset = [], [], 0
+        if internal.rwdata is not None:
+            for data, dst in zip(internal.rwdata.datas, internal.rwdata.dsts):
+                elements.append((offset, len(data), dst))
+                blobs.append(bytes(data))
+                offset += len(data)
+
+        atomic_write_bytes(self._file("internal.bin"), internal)
+        atomic_write_bytes(self._file("external.bin"), external)
+        atomic_write_bytes(self._file("rwdata.bin"), b"".join(blobs))
+
+        self.meta = {
+            "version": self.VERSION,
+            "rwdata": {
+                "elements": elements,
+                "last_fn": None if internal.rwdata is None else internal.rwdata.last_fn,
+            },
+        }
+        atomic_write_bytes(
+            self._file("json"), json.dumps(self.meta, indent="\t").encode()
+        )
@@ -0,0 +1,62 @@
+"""Per-device constants.
+
+This module must stay dependency-free (including the rest of ``patches``)
+so that the Makefile can cheaply query it on every ``make`` invocation.
+"""
+
+from typing import NamedTuple
+
+
+class DeviceMetadata(NamedTuple):
+    name: str
+
+    int_sha1: str  # SHA1 of the stock internal firmware.
+    ext_sha1: str  # SHA1 of the stock external firmware (see ``Ext._verify``).
+
+    # Where novel code starts in the internal firmware; used in the linker script.
+    stock_rom_end: int
+    key_offset: int  # OTFDEC key location in the internal firmware.
+    nonce_offset: int  # OTFDEC nonce location in the internal firmware.
+
+    # Free RAM region for the novel code's .data/.bss; used in the linker script.
+    ram_origin: int
+    ram_length: int
+
+
+MARIO = DeviceMetadata(
+    name="mario",
+    int_sha1="efa04c387ad7b40549e15799b471a6e1cd234c76",
+    ext_sha1="eea70bb171afece163fb4b293c5364ddb90637ae",
+    # Note: this isn't the ACTUAL Stock ROM end, this is actually
+    # pointing to where some rwdata is, but this data will be relocated
+    # and compressed.
+    stock_rom_end=0x18100,
+    key_offset=0x106F4,
+    nonce_offset=0x106E4,
+    ram_origin=0x30010000,
+    ram_length=64 * (1 << 10) - 8192,
+)
+
+ZELDA = DeviceMetadata(
+    name="zelda",
+    int_sha1="ac14bcea6e4ff68c88fd2302c021025a2fb47940",
+    ext_sha1="1c1c0ed66d07324e560dcd9e86a322ec5e4c1e96",
+    stock_rom_end=0x1B3E0,
+    key_offset=0x165A4,
+    nonce_offset=0x16590,
+    ram_origin=0x240EC524,
+    # The last 8 KB of the free RAM, up to 0x240FCFF8, is ``ZeldaGnW.FreeMemory``;
+    # it holds the LoZ2 timer block.
+    ram_length=68308 - 0x2000,
+)
+
+DEVICES = {device.name: device for device in (MARIO, ZELDA)}
+
+
+def linker_script(device):
+    """Contents of the device-specific ``build/device.ld``."""
+    return (
+        f"\n__STOCK_ROM_END__ = 0x{device.stock_rom_end:08X};\n"
+        f"\n__RAM_ORIGIN__ = 0x{device.ram_origin:08x};\n"
+        f"__RAM_LENGTH__ = {device.ram_length};\n"
+    )
@@ -26,5 +26,13 @@ class InvalidIPSError(Exception):
     """Corrupt IPS Patch file"""
 
 
+class InvalidBPSError(Exception):
+    """Corrupt BPS Patch file or wrong source ROM"""
+
+
 class InvalidAsmError(Exception):
     """Bad ASM instructions provided to keystone-engine."""
+
+
+class UnsupportedAsmError(InvalidAsmError):
+    """Instruction not supported by the built-in Thumb-2 assembler."""
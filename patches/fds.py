@@ -0,0 +1,166 @@
+"""Famicom Disk System images.
+
+https://wiki.nesdev.org/w/index.php/FDS_disk_format
+
+A disk side is a sequence of blocks. On the real disk (and in the Game &
+Watch external flash) every block is followed by its 2 byte CRC; the ``.fds``
+file format used by emulators omits the CRCs and zero pads every side to
+65500 bytes.
+
+Parsing only builds an index of the blocks over a ``memoryview`` of the
+source; serializing copies every block once into a preallocated buffer.
+"""
+
+from typing import NamedTuple
+
+from .exception import ParsingError
+from .utils import fds_crcs
+
+SIDE_SIZE = 65500  # Gapless side in an .fds file
+GAPPED_SIDE_SIZE = 0x1_0000  # Side with CRCs in the external flash
+FWNES_HEADER = b"FDS\x1a"
+FWNES_HEADER_SIZE = 16
+
+DISK_INFO = 1
+FILE_AMOUNT = 2
+FILE_HEADER = 3
+FILE_DATA = 4
+
+_CRC_SIZE = 2
+
+
+class Block(NamedTuple):
+    offset: int  # Offset in the source data, excluding any CRC
+    size: int  # Excluding the CRC
+    type: int
+
+
+class FdsSide:
+    """Index of the blocks of one disk side.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Side starting with the disk info block. Trailing data (padding) is
+        ignored.
+    gapped : bool
+        Whether every block in ``data`` is followed by its CRC.
+    """
+
+    def __init__(self, data, gapped=True):
+        self.data = memoryview(data).cast("B")
+        self.blocks = []
+
+        crc_size = _CRC_SIZE if gapped else 0
+        offset = 0
+
+        def add(size, block_type):
+            nonlocal offset
+            if offset + size > len(self.data):
+                raise ParsingError(
+                    f"Block at 0x{offset:X} (type {block_type}) exceeds the data"
+                )
+            if self.data[offset] != block_type:
+                raise ParsingError(
+                    f"Expected block type {block_type} at 0x{offset:X}, "
+                    f"got {self.data[offset]}"
+                )
+            self.blocks.append(Block(offset, size, block_type))
+            offset += size + crc_size
+
+        add(0x38, DISK_INFO)
+        add(0x2, FILE_AMOUNT)
+        n_files = self.data[self.blocks[-1].offset + 1]
+        for _ in range(n_files):
+            add(0x10, FILE_HEADER)
+            header = self.blocks[-1].offset
+            file_size = int.from_bytes(self.data[header + 13 : header + 15], "little")
+            add(file_size + 1, FILE_DATA)
+
+        self.size = offset  # Consumed bytes in the source layout
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, index):
+        """Contents of block ``index`` (without CRC)."""
+        block = self.blocks[index]
+        return self.data[block.offset : block.offset + block.size]
+
+    def serialized_size(self, gapped):
+        size = sum(x.size for x in self.blocks)
+        if gapped:
+            size += _CRC_SIZE * len(self.blocks)
+        return size
+
+    def write_into(self, out, offset, gapped):
+        """Write the blocks to ``out[offset:]``.
+
+        Returns
+        -------
+        int
+            Offset after the last written byte.
+        """
+        crcs = fds_crcs(self[i] for i in range(len(self))) if gapped else None
+        for i, block in enumerate(self.blocks):
+            out[offset : offset + block.size] = self[i]
+            offset += block.size
+            if gapped:
+                out[offset : offset + _CRC_SIZE] = crcs[i]
+                offset += _CRC_SIZE
+        return offset
+
+
+class FdsDisk:
+    """One or more disk sides."""
+
+    def __init__(self, sides):
+        self.sides = list(sides)
+
+    @classmethod
+    def from_gapped(cls, data, offsets, side_size=GAPPED_SIDE_SIZE):
+        """Parse the sides at ``offsets`` of e.g. the external flash, without copying."""
+        data = memoryview(data).cast("B")
+        return cls(FdsSide(data[x : x + side_size]) for x in offsets)
+
+    @classmethod
+    def from_fds(cls, data):
+        """Parse an ``.fds`` file (gapless, 65500 bytes per side, optional fwNES header)."""
+        data = memoryview(data).cast("B")
+        if data[: len(FWNES_HEADER)] == FWNES_HEADER:
+            data = data[FWNES_HEADER_SIZE:]
+        return cls(
+            FdsSide(data[i : i + SIDE_SIZE], gapped=False)
+            for i in range(0, len(data) - SIDE_SIZE + 1, SIDE_SIZE)
+        )
+
+    def to_bytes(self, gapped=False, pad=None):
+        """Serialize all sides into a single buffer.
+
+        Parameters
+        ----------
+        gapped : bool
+            Follow every block by its CRC.
+        pad : int
+            Zero pad every side to this length. Defaults to ``SIDE_SIZE``
+            for gapless sides, i.e. an ``.fds`` file without header.
+
+        Returns
+        -------
+        bytearray
+        """
+        if pad is None and not gapped:
+            pad = SIDE_SIZE
+        sizes = [x.serialized_size(gapped) for x in self.sides]
+        if pad is not None:
+            for side, size in zip(self.sides, sizes):
+                if size > pad:
+                    raise ParsingError(f"Disk side of {size} bytes exceeds {pad}")
+            sizes = [pad] * len(sizes)
+
+        out = bytearray(sum(sizes))
+        offset = 0
+        for side, size in zip(self.sides, sizes):
+            side.write_into(out, offset, gapped)
+            offset += size
+        return out
@@ -1,20 +1,26 @@
+import functools
 import hashlib
 import struct
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass
+from pathlib import Path
 
 from colorama import Fore, Style
-from Crypto.Cipher import AES
-from elftools.elf.elffile import ELFFile
 
+from .allocator import RegionAllocator
+from .artifacts import DEFAULT_GROUPS, ArtifactWriter
 from .compression import lz77_decompress, lzma_compress
 from .exception import (
+    InvalidPatchError,
     InvalidStockRomError,
     MissingSymbolError,
     NotEnoughSpaceError,
     ParsingError,
 )
+from .intervals import WriteLog
 from .patch import FirmwarePatchMixin
-from .utils import round_down_word, round_up_page, round_up_word
+from .symbols import SymbolIndex
+from .utils import printe, printi, round_up_page, round_up_word
 
 
 def _val_to_color(val):
@@ -42,6 +48,18 @@ class Lookup(dict):
         return "\n".join(substrs)
 
 
+def _relocation(method):
+    """Tag the writes of a relocation helper with its source, see ``patch_step``."""
+
+    @functools.wraps(method)
+    def wrapper(self, ext, *args, **kwargs):
+        origin = f"relocate 0x{ext:06X}" if isinstance(ext, int) else "relocate data"
+        with self.patch_step(origin):
+            return method(self, ext, *args, **kwargs)
+
+    return wrapper
+
+
 METADATA_MAGIC = 0x4  # chosen because no real executable code starts with address 0x4
 
 
@@ -99,7 +117,18 @@ class Firmware(FirmwarePatchMixin, bytearray):
     FLASH_BASE = 0x0000_0000
     FLASH_LEN = 0
 
-    def __init__(self, firmware=None):
+    # ``WriteLog`` that records writes while ``Device.__call__`` runs.
+    patch_index = None
+
+    def __init__(self, firmware=None, verify=True):
+        """
+        Parameters
+        ----------
+        firmware : Path
+            Path to a firmware dump.
+        verify : bool
+            Check the stock hash. Only disable for previously verified data.
+        """
         if firmware:
             with open(firmware, "rb") as f:
                 firmware_data = f.read()
@@ -108,7 +137,8 @@ class Firmware(FirmwarePatchMixin, bytearray):
             super().__init__(self.FLASH_LEN)
 
         self._lookup = Lookup()
-        self._verify()
+        if verify:
+            self._verify()
 
     def _verify(self):
         pass
@@ -155,8 +185,25 @@ class Firmware(FirmwarePatchMixin, bytearray):
                         f"firmware length {len(self)} ({hex(len(self))})"
                     ) from None
 
+        if self.patch_index is not None:
+            if isinstance(key, slice):
+                if key.start is None and key.stop is None:
+                    # Whole firmware is replaced, e.g. ``shorten``
+                    self.patch_index.truncate(len(new_val))
+                else:
+                    start = key.indices(len(self))[0]
+                    self.record_write(start, start + len(new_val))
+            else:
+                start = key % len(self)
+                self.record_write(start, start + 1)
+
         return super().__setitem__(key, new_val)
 
+    def record_write(self, start: int, end: int, origin=None):
+        """Record that ``[start, end)`` was written (no-op if not tracking)."""
+        if self.patch_index is not None:
+            self.patch_index.add(start, end, origin)
+
     def __str__(self):
         return self.__name__
 
@@ -172,7 +219,45 @@ class Firmware(FirmwarePatchMixin, bytearray):
         return end - start
 
     def clear_range(self, start: int, end: int):
-        return self.set_range(start, end, val=b"\x00")
+        patch_index, self.patch_index = self.patch_index, None
+        try:
+            return self.set_range(start, end, val=b"\x00")
+        finally:
+            self.patch_index = patch_index
+            if patch_index is not None:
+                patch_index.remove(start, end)
+
+    def literal_pools(self, start=0, end=None):
+        """Offsets of the words loaded by PC-relative ``ldr`` in ``[start, end)``.
+
+        Every halfword is treated as a potential instruction, so this is a
+        superset; only use it to filter candidate pointer locations.
+
+        Returns
+        -------
+        numpy.ndarray
+            Sorted, word-aligned offsets.
+        """
+        import numpy as np
+
+        end = len(self) if end is None else end
+        start = round_up_word(start)
+        hw = np.frombuffer(
+            self, dtype="<u2", count=(end - start) // 2, offset=start
+        ).astype(np.int64)
+        addr = start + 2 * np.arange(len(hw))
+
+        # LDR Rt, [PC, #imm8 * 4]
+        t1 = (hw & 0xF800) == 0x4800
+        t1_targets = ((addr[t1] + 4) & ~3) + (hw[t1] & 0xFF) * 4
+
+        # LDR.W Rt, [PC, #+/-imm12]
+        t2 = np.flatnonzero((hw[:-1] & 0xFF7F) == 0xF85F)
+        sign = np.where(hw[t2] & 0x80, 1, -1)
+        t2_targets = ((addr[t2] + 4) & ~3) + sign * (hw[t2 + 1] & 0xFFF)
+
+        targets = np.unique(np.concatenate([t1_targets, t2_targets]))
+        return targets[(targets % 4 == 0) & (targets >= 0) & (targets + 4 <= len(self))]
 
     def show(self, wrap=1024, show=True):
         import matplotlib.pyplot as plt
@@ -253,6 +338,23 @@ class RWData:
             table_start, table_start + 16 * self.MAX_TABLE_ELEMENTS + 4, b"\x77"
         )
 
+    @classmethod
+    def restore(cls, firmware, table_start, elements, last_fn):
+        """Recreate a previously parsed table without decompressing it again.
+
+        ``firmware`` must already have the parsing side-effects applied
+        (cleared compressed data and reserved table area).
+        """
+        self = cls.__new__(cls)
+        self.firmware = firmware
+        self.table_start = table_start
+        self.__compressed_len_memo = {}
+        self.datas, self.dsts = [], []
+        for data, dst in elements:
+            self.append(data, dst)
+        self.last_fn = last_fn
+        return self
+
     def __getitem__(self, k):
         return self.datas[k]
 
@@ -384,15 +486,23 @@ class IntFirmware(Firmware):
     RWDATA_ITCM_IDX = None
     RWDATA_DTCM_IDX = None
 
-    def __init__(self, firmware, elf):
-        super().__init__(firmware)
-        self._elf_f = open(elf, "rb")
-        self.elf = ELFFile(self._elf_f)
-        self.symtab = self.elf.get_section_by_name(".symtab")
+    def __init__(self, firmware, elf, rwdata=None, verify=True):
+        """
+        Parameters
+        ----------
+        rwdata : tuple
+            ``(elements, last_fn)`` from ``StockCache.rwdata`` to skip
+            parsing the rwdata table.
+        """
+        super().__init__(firmware, verify=verify)
+        self.symbols = SymbolIndex.load(elf)
+        self._resolved = set()
         if self.RWDATA_OFFSET is None:
             self.rwdata = None
-        else:
+        elif rwdata is None:
             self.rwdata = RWData(self, self.RWDATA_OFFSET, self.RWDATA_LEN)
+        else:
+            self.rwdata = RWData.restore(self, self.RWDATA_OFFSET, *rwdata)
 
     def _verify(self):
         h = hashlib.sha1(self).hexdigest()
@@ -400,17 +510,91 @@ class IntFirmware(Firmware):
             raise InvalidStockRomError
 
     def address(self, symbol_name, sub_base=False):
-        symbols = self.symtab.get_symbol_by_name(symbol_name)
-        if not symbols:
-            raise MissingSymbolError(f'Cannot find symbol "{symbol_name}"')
-        address = symbols[0]["st_value"]
+        try:
+            address = self.symbols[symbol_name].value
+        except KeyError:
+            raise MissingSymbolError(f'Cannot find symbol "{symbol_name}"') from None
         if address == 0:
             raise MissingSymbolError(f"{symbol_name} has address 0x0")
-        print(f"    found {symbol_name} at 0x{address:08X}")
+        if symbol_name not in self._resolved:
+            self._resolved.add(symbol_name)
+            print(f"    found {symbol_name} at 0x{address:08X}")
         if sub_base:
             address -= self.FLASH_BASE
         return address
 
+    def _in_flash_window(self, address):
+        """If ``address`` is in the internal flash memory region (any bank)."""
+        return self.FLASH_BASE <= address < self.FLASH_BASE + 0x0100_0000
+
+    def load_elf(self, elf, start=None):
+        """Copy the novel code straight from the ELF's loadable segments.
+
+        Equivalent to copying ``gw_patch.bin[start:]`` over the firmware, but
+        without needing the objcopy'd full-size binary.
+
+        Parameters
+        ----------
+        elf : Path
+        start : int
+            Offset into firmware to begin writing at.
+            Defaults to ``STOCK_ROM_END``.
+        """
+        from elftools.elf.elffile import ELFFile
+
+        if start is None:
+            start = self.STOCK_ROM_END
+
+        errors = []
+
+        # Validate all exported symbols that land in internal flash.
+        for name, symbol in self.symbols.items():
+            if symbol.type not in ("STT_FUNC", "STT_OBJECT"):
+                continue
+            address = symbol.value & ~1
+            if not self._in_flash_window(address):
+                continue
+            end = address - self.FLASH_BASE + symbol.size
+            if end > len(self):
+                errors.append(
+                    f"{name} [0x{address:08X}, 0x{self.FLASH_BASE + end:08X}) exceeds "
+                    f"firmware length 0x{len(self):X}"
+                )
+
+        self.clear_range(start, len(self))
+
+        with open(elf, "rb") as f:
+            for segment in ELFFile(f).iter_segments():
+                if segment["p_type"] != "PT_LOAD" or not segment["p_filesz"]:
+                    continue
+                seg_start = segment["p_paddr"] - self.FLASH_BASE
+                seg_end = seg_start + segment["p_filesz"]
+                if not (0 <= seg_start and seg_end <= len(self)):
+                    if self._in_flash_window(segment["p_paddr"]):
+                        errors.append(
+                            f"PT_LOAD [0x{segment['p_paddr']:08X}, "
+                            f"0x{self.FLASH_BASE + seg_end:08X}) exceeds "
+                            f"firmware length 0x{len(self):X}"
+                        )
+                    continue
+                if seg_end <= start:
+                    continue
+
+                data = segment.data()
+                if seg_start < start:
+                    data = data[start - seg_start :]
+                    seg_start = start
+                self[seg_start : seg_start + len(data)] = data
+
+        if errors:
+            raise InvalidPatchError("\n".join(errors))
+
+    @property
+    def empty_search_start(self):
+        if self.rwdata is None:
+            return self.STOCK_ROM_END
+        return self.rwdata.table_end
+
     @property
     def empty_offset(self):
         """Detect a series of 0x00 to figure out the end of the internal firmware.
@@ -421,11 +605,7 @@ class IntFirmware(Firmware):
             Offset into firmware where empty region begins.
         """
 
-        if self.rwdata is None:
-            search_start = self.STOCK_ROM_END
-        else:
-            search_start = self.rwdata.table_end
-        for addr in range(search_start, self.FLASH_LEN, 0x10):
+        for addr in range(self.empty_search_start, self.FLASH_LEN, 0x10):
             if self[addr : addr + 256] == b"\x00" * 256:
                 int_pos_start = addr
                 break
@@ -459,6 +639,8 @@ class ExtFirmware(Firmware):
 
     def crypt(self, key, nonce):
         """Decrypts if encrypted; encrypts if in plain text."""
+        from Crypto.Cipher import AES
+
         key = bytes(key[::-1])
         iv = bytearray(_nonce_to_iv(nonce))
 
@@ -486,9 +668,44 @@ class Device:
         cls.name = name
         cls.registry[name] = cls
 
-    def __init__(self, internal_bin, internal_elf, external_bin):
-        self.internal = self.Int(internal_bin, internal_elf)
-        self.external = self.Ext(external_bin)
+    def __init__(
+        self, internal_bin, internal_elf, external_bin, stock_cache=None, args=None
+    ):
+        """
+        Parameters
+        ----------
+        stock_cache : StockCache
+            Optional cache of the decrypted/decompressed stock firmware.
+        args : argparse.Namespace
+            Arguments returned by ``argparse``.
+        """
+        self.args = args
+        self.stock_cache = stock_cache
+        self.artifacts = ArtifactWriter(
+            DEFAULT_GROUPS
+            if args is None
+            else getattr(args, "artifacts", DEFAULT_GROUPS)
+        )
+
+        if stock_cache is not None and stock_cache.load(
+            self.name, internal_bin, external_bin
+        ):
+            # The entry is keyed on the full SHA1 of both dumps, and is only
+            # stored after they passed verification.
+            self.internal = self.Int(
+                stock_cache.file("internal"),
+                internal_elf,
+                rwdata=stock_cache.rwdata(),
+                verify=False,
+            )
+            self.external = self.Ext(stock_cache.file("external"), verify=False)
+        else:
+            self.internal = self.Int(internal_bin, internal_elf)
+            self.external = self.Ext(external_bin)
+            self.crypt()  # Decrypt the external firmware
+            if stock_cache is not None:
+                stock_cache.store(self.internal, self.external)
+
         self.compressed_memory = self.FreeMemory()
 
         # Link all lookup tables to a single device instance
@@ -497,9 +714,18 @@ class Device:
         self.external._lookup = self.lookup
         self.compressed_memory._lookup = self.lookup
 
-        self.ext_offset = 0
+        # Free-list of the external flash; regions are freed when they're
+        # deleted or moved elsewhere.
+        self.ext_alloc = RegionAllocator(len(self.external))
         self.int_pos = 0
         self.compressed_memory_pos = 0
+        # Payload -> offset of every blob moved into compressed_memory
+        self._compressed_memory_blobs = {}
+        # ``(ext, compressed_memory offset, saved bytes)`` of deduplicated blobs
+        self.dedup_saved = []
+
+        # Firmware name -> ``WriteLog`` of the writes made by ``__call__``.
+        self.patch_indices = {}
 
     def _move_copy(
         self, dst, dst_offset: int, src, src_offset: int, size: int, delete: bool
@@ -542,6 +768,50 @@ class Device:
     def crypt(self):
         self.external.crypt(self.internal.key, self.internal.nonce)
 
+    def dump(self, path, producer, group="debug", stock=True):
+        """Write a debugging/development artifact in the background.
+
+        ``producer`` is only called if ``group`` was requested via
+        ``--artifacts``; it's called right away, so it may read the current
+        firmware state.
+
+        Parameters
+        ----------
+        path : Path
+        producer : callable
+            Returns either ``bytes`` or a ``PIL.Image.Image``.
+        group : str
+            See ``artifacts.GROUPS``.
+        stock : bool
+            Derived purely from stock data; skipped if the stock cache was
+            reused and ``path`` already exists.
+        """
+        self.dump_many([path], lambda: [producer()], group=group, stock=stock)
+
+    def dump_many(self, paths, producer, group="debug", stock=True):
+        """Like ``dump``, for artifacts that are cheaper to produce together.
+
+        Parameters
+        ----------
+        paths : list
+        producer : callable
+            Returns one ``bytes`` or ``PIL.Image.Image`` per path.
+        """
+        if not self.artifacts.wants(group):
+            return
+
+        paths = [Path(x) for x in paths]
+        if (
+            stock
+            and self.stock_cache is not None
+            and self.stock_cache.hit
+            and all(x.exists() for x in paths)
+        ):
+            return
+
+        for path, data in zip(paths, producer()):
+            self.artifacts.submit(path, data)
+
     def show(self, show=True):
         import matplotlib.pyplot as plt
 
@@ -592,12 +862,42 @@ class Device:
                 self.internal.rwdata[self.internal.RWDATA_DTCM_IDX][i : i + 4], "little"
             )
             if lower <= val < upper:
-                new_val = self.lookup[val]
+                try:
+                    new_val = self.lookup[val]
+                except KeyError:
+                    raise InvalidPatchError(
+                        f"rwdata word 0x{val:08X} at offset 0x{i:X} points into "
+                        f"the moved region 0x{lower:08X}-0x{upper:08X}, but its "
+                        "new location is unknown."
+                    ) from None
                 print(f"    updating rwdata 0x{val:08X} -> 0x{new_val:08X}")
                 self.internal.rwdata[self.internal.RWDATA_DTCM_IDX][
                     i : i + 4
                 ] = new_val.to_bytes(4, "little")
 
+    def literal_pool_lookup(self, firmware, lower, size, start=0, end=None):
+        """Update literal pool pointers in ``firmware[start:end]`` that point
+        into the moved external region ``[lower, lower + size]``.
+
+        The end is inclusive so that end-of-region pointers are updated if the
+        lookup has an entry for them.
+
+        Returns
+        -------
+        int
+            Number of updated pointers.
+        """
+        lower += self.external.FLASH_BASE
+        upper = lower + size
+
+        offsets = []
+        for offset in firmware.literal_pools(start, end).tolist():
+            val = firmware.int(offset)
+            if lower <= val <= upper and val in self.lookup:
+                offsets.append(offset)
+        firmware.lookup(offsets)
+        return len(offsets)
+
     def rwdata_erase(self, lower, size):
         """
         Erasing no longer used references makes it compress better.
@@ -614,6 +914,7 @@ class Device:
                     i : i + 4
                 ] = b"\x00\x00\x00\x00"
 
+    @_relocation
     def move_to_int(self, ext, size, reference):
         if self.int_free_space < size:
             raise NotEnoughSpaceError
@@ -624,6 +925,7 @@ class Device:
             self.internal[self.int_pos : self.int_pos + size] = ext
         else:
             self._move_ext_to_int(ext, self.int_pos, size=size)
+            self.ext_alloc.free(ext, size)
             print(f"    move_ext_to_int {hex(ext)} -> {hex(self.int_pos)}")
         self.int_pos += round_up_word(size)
 
@@ -632,18 +934,30 @@ class Device:
 
         return new_loc
 
+    def free_ext(self, ext, size):
+        """Erase a no longer used external region and make it allocatable."""
+        self.external.clear_range(ext, ext + size)
+        self.ext_alloc.free(ext, size)
+
+    @_relocation
     def move_ext_external(self, ext, size, reference):
-        """Explicitly just moves ext->ext data"""
+        """Explicitly just moves ext->ext data.
+
+        Data is placed in the best fitting free region; existing data is
+        never moved towards the end of the external flash.
+        """
         if isinstance(ext, (bytes, bytearray)):
-            self.external[self.ext_offset : self.ext_offset + size] = ext
+            new_loc = self.ext_alloc.allocate(size)
+            self.external[new_loc : new_loc + size] = ext
         else:
-            self.external.move(ext, self.ext_offset, size=size)
+            self.ext_alloc.free(ext, size)
+            new_loc = self.ext_alloc.allocate(size, limit=ext)
+            # Also when not moving at all, as this populates the lookup.
+            self.external.move(ext, new_loc - ext, size=size)
 
         if reference is not None:
             self.internal.lookup(reference)
 
-        new_loc = ext + self.ext_offset
-
         return new_loc
 
     def move_ext(self, ext, size, reference):
@@ -655,16 +969,135 @@ class Device:
         or is incompressible.
         """
         try:
-            new_loc = self.move_to_int(ext, size, reference)
-            if isinstance(ext, int):
-                self.ext_offset -= round_down_word(size)
-            return new_loc
+            return self.move_to_int(ext, size, reference)
         except NotEnoughSpaceError:
             print(
                 f"        {Fore.RED}Not Enough Internal space. Using external flash{Style.RESET_ALL}"
             )
             return self.move_ext_external(ext, size, reference)
 
+    def _find_in_compressed_memory(self, data):
+        """Word-aligned offset of ``data`` in the used compressed_memory.
+
+        Returns
+        -------
+        int
+            Offset of an identical payload or of a payload that contains
+            ``data``; ``None`` if there is none.
+        """
+        with suppress(KeyError):
+            return self._compressed_memory_blobs[data]
+
+        used = bytes(self.compressed_memory[: self.compressed_memory_pos])
+        offset = used.find(data)
+        while offset >= 0 and offset % 4:
+            offset = used.find(data, offset + 1)
+        return None if offset < 0 else offset
+
+    def _compressed_memory_overlap(self, data):
+        """Length of the longest word-aligned tail of the used compressed_memory
+        that is a prefix of ``data``."""
+        pos = self.compressed_memory_pos
+        used = self.compressed_memory[max(0, pos - len(data)) : pos]
+        for n in range(len(used) - len(used) % 4, 0, -4):
+            if used[-n:] == data[:n]:
+                return n
+        return 0
+
+    def _link_to_compressed_memory(self, ext, size, offset):
+        """Point ``ext`` at identical data already at ``offset`` and erase it."""
+        for i in range(size):
+            self.lookup[self.external.FLASH_BASE + ext + i] = (
+                self.compressed_memory.FLASH_BASE + offset + i
+            )
+        self.external.clear_range(ext, ext + size)
+
+    def _dedup_to_compressed_memory(self, ext, size, offset, reference):
+        self._link_to_compressed_memory(ext, size, offset)
+        self.ext_alloc.free(ext, size)
+        self.dedup_saved.append((ext, offset, size))
+        print(f"    dedup {hex(ext)} -> compressed_memory {hex(offset)} ({size} bytes)")
+        if reference is not None:
+            self.internal.lookup(reference)
+        return offset
+
+    def recompress_backdrops(self, backdrops, end, align=32):
+        """Re-encode the backdrop images in ``[backdrops[0][1], end)`` and pack
+        them back-to-back.
+
+        The old image start addresses are added to the lookup; the caller
+        updates the references. The freed tail is erased and allocatable.
+
+        Raises ``InvalidPatchError`` if a literal pool or DTCM rwdata word
+        points into the images anywhere but at an image start, since such a
+        reference can't follow the re-encoded data.
+
+        Parameters
+        ----------
+        backdrops : list
+            ``(name, offset)`` tuples in ascending order.
+
+        Returns
+        -------
+        int
+            Length of the packed images.
+        """
+        from .tileset import backdrop_size, recompress_backdrop
+
+        start = backdrops[0][1]
+        self._check_backdrop_references(backdrops, end)
+
+        external = memoryview(self.external)
+        sizes = [backdrop_size(external[x:end]) for _, x in backdrops]
+        images = [
+            recompress_backdrop(external[x : x + size])
+            for (_, x), size in zip(backdrops, sizes)
+        ]
+        external.release()
+
+        self.external.clear_range(start, end)
+        offset = start
+        for (name, old), size, data in zip(backdrops, sizes, images):
+            self.external[offset : offset + len(data)] = data
+            self.lookup[self.external.FLASH_BASE + old] = (
+                self.external.FLASH_BASE + offset
+            )
+            print(f"    {name}: {size} -> {len(data)} bytes (saves {size - len(data)})")
+            offset = -(-(offset + len(data)) // align) * align
+
+        offset = min(offset, end)
+        self.free_ext(offset, end - offset)
+        printi(f"    saved {end - offset} bytes of backdrop images")
+        return offset - start
+
+    def _check_backdrop_references(self, backdrops, end):
+        lower = self.external.FLASH_BASE + backdrops[0][1]
+        upper = self.external.FLASH_BASE + end
+        starts = {self.external.FLASH_BASE + x for _, x in backdrops}
+
+        rwdata = self.internal.rwdata[self.internal.RWDATA_DTCM_IDX]
+        words = [
+            (f"internal 0x{offset:06X}", self.internal.int(offset))
+            for offset in self.internal.literal_pools(
+                end=self.internal.STOCK_ROM_END
+            ).tolist()
+        ]
+        words.extend(
+            (f"rwdata 0x{i:X}", int.from_bytes(rwdata[i : i + 4], "little"))
+            for i in range(0, len(rwdata) - 3, 4)
+        )
+        bad = [
+            f"{location}: 0x{val:08X}"
+            for location, val in words
+            if lower <= val < upper and val not in starts
+        ]
+        if bad:
+            raise InvalidPatchError(
+                "References into the middle of the backdrop images can't be "
+                "updated after re-encoding them:\n    " + "\n    ".join(bad)
+            )
+
+    @_relocation
     def move_to_compressed_memory(self, ext, size, reference):
         """Attempt to relocate in priority order:
         1. compressed_memory
@@ -672,22 +1105,35 @@ class Device:
         3. External
 
         This is the primary moving method for any compressible data.
+
+        Data that is already in compressed_memory (e.g. an identical palette
+        or tile) isn't stored again; all references point at the first copy.
+        If only its beginning matches the end of compressed_memory, the data
+        is placed overlapping it.
         """
+        data = bytes(self.external[ext : ext + size])
+        offset = self._find_in_compressed_memory(data)
+        if offset is not None:
+            return self._dedup_to_compressed_memory(ext, size, offset, reference)
+
+        overlap = self._compressed_memory_overlap(data)
+        start = self.compressed_memory_pos - overlap
+
         current_len = self.compressed_memory_compressed_len()
 
         try:
-            self.compressed_memory[
-                self.compressed_memory_pos : self.compressed_memory_pos + size
-            ] = self.external[ext : ext + size]
+            self.compressed_memory[self.compressed_memory_pos : start + size] = data[
+                overlap:
+            ]
         except NotEnoughSpaceError:
             print(
                 f"        {Fore.RED}compressed_memory full. Attempting to put in internal{Style.RESET_ALL}"
             )
             return self.move_ext(ext, size, reference)
 
-        new_len = self.compressed_memory_compressed_len(size)
+        new_len = self.compressed_memory_compressed_len(size - overlap)
         diff = new_len - current_len
-        compression_ratio = size / diff
+        compression_ratio = size / diff if diff > 0 else float("inf")
 
         print(
             f"    {Fore.YELLOW}compression_ratio: {compression_ratio}{Style.RESET_ALL}"
@@ -698,52 +1144,179 @@ class Device:
                 f"        {Fore.RED}not putting into free memory due not enough free "
                 f"internal storage for compressed data.{Style.RESET_ALL}"
             )
-            self.compressed_memory.clear_range(
-                self.compressed_memory_pos, self.compressed_memory_pos + size
-            )
+            self.compressed_memory.clear_range(self.compressed_memory_pos, start + size)
             return self.move_ext_external(ext, size, reference)
         elif compression_ratio < self.args.compression_ratio:
             # Revert putting this data into compressed_memory due to poor space_savings
             print(
                 f"        {Fore.RED}not putting in free memory due to poor compression.{Style.RESET_ALL}"
             )
-            self.compressed_memory.clear_range(
-                self.compressed_memory_pos, self.compressed_memory_pos + size
-            )
+            self.compressed_memory.clear_range(self.compressed_memory_pos, start + size)
             return self.move_ext(ext, size, reference)
         # Even though the data is already moved, this builds the reference lookup
-        self._move_to_compressed_memory(ext, self.compressed_memory_pos, size=size)
-
-        print(
-            f"    move_to_compressed_memory {hex(ext)} -> {hex(self.compressed_memory_pos)}"
+        self._move_to_compressed_memory(
+            ext + overlap, self.compressed_memory_pos, size=size - overlap
         )
+
+        print(f"    move_to_compressed_memory {hex(ext)} -> {hex(start)}")
+        if overlap:
+            self._link_to_compressed_memory(ext, overlap, start)
+            print(f"    overlapping previous data by {overlap} bytes")
+            self.dedup_saved.append((ext, start, overlap))
         if reference is not None:
             self.internal.lookup(reference)
-        new_loc = self.compressed_memory_pos
-        self.compressed_memory_pos += round_up_word(size)
-        self.ext_offset -= round_down_word(size)
-
-        return new_loc
+        self._compressed_memory_blobs.setdefault(data, start)
+        self.compressed_memory_pos = start + round_up_word(size)
+        self.ext_alloc.free(ext, size)
+
+        return start
+
+    def report_dedup(self):
+        if not self.dedup_saved:
+            return
+        printi(
+            f"Deduplicated {len(self.dedup_saved)} compressed_memory blobs, "
+            f"saving {sum(x[2] for x in self.dedup_saved)} bytes"
+        )
 
     def __call__(self):
         from . import MarioGnW, ZeldaGnW
 
         self.int_pos = self.internal.empty_offset
-        out = self.patch()
-        is_mario, is_zelda = False, False
-        if isinstance(self, MarioGnW):
-            is_mario = True
-        elif isinstance(self, ZeldaGnW):
-            is_zelda = True
-        metadata = HeaderMetaData(
-            external_flash_size=len(self.external),
-            is_mario=is_mario,
-            is_zelda=is_zelda,
-        )
-        # hdmi-cec = 0x01B8; not used in the gnw hardware.
-        self.internal.replace(0x01B8, metadata.pack())
+
+        self._verify_free_memory()
+
+        firmwares = self._firmwares()
+        for firmware in firmwares.values():
+            firmware.patch_index = WriteLog()
+        try:
+            with self.patch_step(self.name):
+                out = self.patch()
+            is_mario, is_zelda = False, False
+            if isinstance(self, MarioGnW):
+                is_mario = True
+            elif isinstance(self, ZeldaGnW):
+                is_zelda = True
+            metadata = HeaderMetaData(
+                external_flash_size=len(self.external),
+                is_mario=is_mario,
+                is_zelda=is_zelda,
+            )
+            # hdmi-cec = 0x01B8; not used in the gnw hardware.
+            with self.patch_step("header"):
+                self.internal.replace(0x01B8, metadata.pack())
+        finally:
+            # Stop recording; e.g. encryption rewrites every byte.
+            self.patch_indices = {}
+            for name, firmware in firmwares.items():
+                self.patch_indices[name] = firmware.patch_index
+                firmware.patch_index = None
+
+        self.report_patch_conflicts()
+        self.report_dedup()
         return out
 
+    @contextmanager
+    def patch_step(self, origin):
+        """Tag the writes made inside the ``with`` block with ``origin``.
+
+        ``__call__`` tags the whole ``patch`` with the device name and every
+        relocation with its source; wrap a patch step to tell it apart from
+        the rest of ``patch`` in the conflict report.
+        """
+        logs = [
+            firmware.patch_index
+            for firmware in self._firmwares().values()
+            if firmware.patch_index is not None
+        ]
+        previous = [log.origin for log in logs]
+        for log in logs:
+            log.origin = origin
+        try:
+            yield
+        finally:
+            for log, prev in zip(logs, previous):
+                log.origin = prev
+
+    def _verify_free_memory(self):
+        """Make sure ``FreeMemory`` doesn't overlap RAM used by anything else."""
+        start = self.compressed_memory.FLASH_BASE
+        end = start + len(self.compressed_memory)
+        if start == end:
+            return
+
+        used = []
+        if self.internal.rwdata is not None:
+            for i, (data, dst) in enumerate(
+                zip(self.internal.rwdata.datas, self.internal.rwdata.dsts)
+            ):
+                used.append((dst, dst + len(data), f"rwdata element {i}"))
+        symbols = self.internal.symbols
+        if "_sdata" in symbols and "_ebss" in symbols:
+            used.append(
+                (symbols["_sdata"].value, symbols["_ebss"].value, "novel .data/.bss")
+            )
+
+        errors = [
+            f"FreeMemory 0x{start:08X}-0x{end:08X} overlaps {name} "
+            f"0x{used_start:08X}-0x{used_end:08X}"
+            for used_start, used_end, name in used
+            if used_start < end and start < used_end
+        ]
+        if errors:
+            raise InvalidPatchError("\n".join(errors))
+
+    def _firmwares(self):
+        return {
+            "internal": self.internal,
+            "external": self.external,
+            "compressed_memory": self.compressed_memory,
+        }
+
+    def report_patch_conflicts(self):
+        """Print every write that overwrote bytes written by another patch.
+
+        Returns
+        -------
+        int
+            Number of conflicts.
+        """
+        n_conflicts = 0
+        for name, patch_index in self.patch_indices.items():
+            firmware = self._firmwares()[name]
+            for conflict in patch_index.conflicts:
+                printe(
+                    f"Patch conflict in {name} "
+                    f"0x{firmware.FLASH_BASE + conflict.start:08X}-"
+                    f"0x{firmware.FLASH_BASE + conflict.end:08X}: "
+                    f"{conflict.origin} overwrote {conflict.previous}"
+                )
+                n_conflicts += 1
+        return n_conflicts
+
+    def owner(self, address: int):
+        """Which patch last wrote to absolute ``address``.
+
+        Returns
+        -------
+        str
+            Origin tag (e.g. ``"relocate 0x0BEC58"``), or ``None`` if unpatched.
+        """
+        for name, patch_index in self.patch_indices.items():
+            firmware = self._firmwares()[name]
+            offset = address - firmware.FLASH_BASE
+            if 0 <= offset < len(firmware):
+                return patch_index.owner(offset)
+        return None
+
+    @classmethod
+    def argparse(cls, parser):
+        """Add device-specific arguments, then parse and validate all arguments.
+
+        Called before any firmware is loaded.
+        """
+        return parser.parse_args()
+
     def patch(self):
         """Device specific argument parsing and patching routine.
         Called from __call__; not to be called otherwise.
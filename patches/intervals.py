@@ -0,0 +1,246 @@
+"""Record of which patch wrote which bytes of a firmware image.
+
+Patch helpers write straight into the firmware, so two patches (or a patch
+and a relocation) can silently clobber each other. ``WriteLog`` appends every
+write with its origin and only works out owners and conflicts once the
+patching is done. ``IntervalIndex`` keeps sorted, disjoint ``[start, end)``
+intervals that are queried while they're updated, e.g. the free regions of
+``RegionAllocator``.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from typing import NamedTuple
+
+
+class Conflict(NamedTuple):
+    start: int
+    end: int
+    previous: str  # Origin of the overwritten bytes
+    origin: str  # Origin of the new write
+
+
+class IntervalIndex:
+    """Sorted, disjoint ``[start, end)`` intervals, each with an origin tag.
+
+    Adjacent intervals with the same tag are merged, so e.g. a byte-by-byte
+    ``asm`` write only occupies a single entry.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._tags = []
+        self.conflicts = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        return zip(self._starts, self._ends, self._tags)
+
+    def _span(self, start, end):
+        """Index range of the intervals overlapping ``[start, end)``."""
+        i = bisect_right(self._starts, start) - 1
+        if i < 0 or self._ends[i] <= start:
+            i += 1
+        j = bisect_left(self._starts, end)
+        return i, j
+
+    def overlapping(self, start, end):
+        """List of ``(start, end, tag)`` intervals overlapping ``[start, end)``."""
+        i, j = self._span(start, end)
+        return list(zip(self._starts[i:j], self._ends[i:j], self._tags[i:j]))
+
+    def owner(self, offset):
+        """Origin tag of the last write to ``offset``, or ``None``."""
+        i = bisect_right(self._starts, offset) - 1
+        if i >= 0 and offset < self._ends[i]:
+            return self._tags[i]
+        return None
+
+    def _replace(self, start, end, tag):
+        i, j = self._span(start, end)
+
+        starts, ends, tags = [], [], []
+        if i < j and self._starts[i] < start:
+            starts.append(self._starts[i])
+            ends.append(start)
+            tags.append(self._tags[i])
+        if tag is not None:
+            starts.append(start)
+            ends.append(end)
+            tags.append(tag)
+        if i < j and self._ends[j - 1] > end:
+            starts.append(end)
+            ends.append(self._ends[j - 1])
+            tags.append(self._tags[j - 1])
+
+        self._starts[i:j] = starts
+        self._ends[i:j] = ends
+        self._tags[i:j] = tags
+
+        # Merge with same-tag neighbours
+        for k in (i + len(starts) - 1, i - 1):
+            if (
+                0 <= k < len(self._starts) - 1
+                and self._ends[k] == self._starts[k + 1]
+                and self._tags[k] == self._tags[k + 1]
+            ):
+                self._ends[k] = self._ends[k + 1]
+                del self._starts[k + 1], self._ends[k + 1], self._tags[k + 1]
+
+    def add(self, start, end, tag):
+        """Record a write; overwriting bytes of another origin is a conflict.
+
+        Returns
+        -------
+        list
+            New ``Conflict`` s caused by this write.
+        """
+        if start >= end:
+            return []
+
+        conflicts = []
+        for s, e, previous in self.overlapping(start, end):
+            if previous == tag:
+                continue
+            s, e = max(s, start), min(e, end)
+            last = self.conflicts[-1] if self.conflicts else None
+            if (
+                last is not None
+                and last.end == s
+                and (last.previous, last.origin) == (previous, tag)
+            ):
+                # e.g. consecutive single-byte writes
+                self.conflicts[-1] = last._replace(end=e)
+            else:
+                conflict = Conflict(s, e, previous, tag)
+                self.conflicts.append(conflict)
+                conflicts.append(conflict)
+
+        self._replace(start, end, tag)
+        return conflicts
+
+    def remove(self, start, end):
+        """Release ``[start, end)``, e.g. after it was cleared or moved away."""
+        if start < end:
+            self._replace(start, end, None)
+
+    def truncate(self, length):
+        """Drop everything at or past ``length``."""
+        if self._starts and self._ends[-1] > length:
+            self.remove(length, self._ends[-1])
+
+
+class WriteLog:
+    """Append-only log of ``[start, end)`` writes, each tagged with an origin.
+
+    Recording a write is a tuple append; a write that continues the previous
+    one with the same origin extends it in place. Owners and conflicts are
+    resolved in ``O(n log n)`` when first queried.
+    """
+
+    def __init__(self):
+        self.origin = "unknown"  # Tag of new writes, see ``Device.patch_step``
+        self._records = []  # ``(start, end, origin)``; ``None`` releases
+        self._resolved = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def _append(self, start, end, tag):
+        if start >= end:
+            return
+        self._resolved = None
+        if self._records:
+            last_start, last_end, last_tag = self._records[-1]
+            if last_tag == tag and last_end == start:
+                # e.g. consecutive single-byte writes
+                self._records[-1] = (last_start, end, tag)
+                return
+        self._records.append((start, end, tag))
+
+    def add(self, start, end, tag=None):
+        """Record a write by ``tag``, or by the current ``origin``."""
+        self._append(start, end, self.origin if tag is None else tag)
+
+    def remove(self, start, end):
+        """Release ``[start, end)``, e.g. after it was cleared or moved away."""
+        self._append(start, end, None)
+
+    def truncate(self, length):
+        """Drop everything at or past ``length``."""
+        end = max((x[1] for x in self._records), default=length)
+        self._append(length, end, None)
+
+    def _resolve(self):
+        """Sweep over the record boundaries.
+
+        Returns
+        -------
+        tuple
+            Disjoint ``(start, end, tag)`` intervals of the last writes and
+            the list of ``Conflict`` s, both sorted by ``start``.
+        """
+        if self._resolved is not None:
+            return self._resolved
+
+        events = []
+        for seq, (start, end, _) in enumerate(self._records):
+            events.append((start, 1, seq))
+            events.append((end, 0, seq))
+        events.sort()
+
+        owners, conflicts, open_conflicts = [], [], {}
+        active = []  # Sequence numbers of the records covering the sweep
+        prev = None
+        for pos, is_start, seq in events:
+            if active and prev < pos:
+                tags = [self._records[x][2] for x in active]
+                if tags[-1] is not None:
+                    if owners and owners[-1][1] == prev and owners[-1][2] == tags[-1]:
+                        owners[-1] = (owners[-1][0], pos, tags[-1])
+                    else:
+                        owners.append((prev, pos, tags[-1]))
+                for previous, tag in zip(tags, tags[1:]):
+                    if previous is None or tag is None or previous == tag:
+                        continue
+                    i = open_conflicts.get((previous, tag))
+                    if i is not None and conflicts[i].end == prev:
+                        conflicts[i] = conflicts[i]._replace(end=pos)
+                    else:
+                        open_conflicts[previous, tag] = len(conflicts)
+                        conflicts.append(Conflict(prev, pos, previous, tag))
+            if is_start:
+                insort(active, seq)
+            else:
+                active.remove(seq)
+            prev = pos
+
+        self._resolved = (owners, conflicts)
+        return self._resolved
+
+    def __iter__(self):
+        return iter(self._resolve()[0])
+
+    @property
+    def conflicts(self):
+        """Every ``Conflict`` where a write overwrote another origin's bytes."""
+        return self._resolve()[1]
+
+    def overlapping(self, start, end):
+        """List of ``(start, end, tag)`` last writes overlapping ``[start, end)``."""
+        owners = self._resolve()[0]
+        i = bisect_right(owners, (start, float("inf"))) - 1
+        if i < 0 or owners[i][1] <= start:
+            i += 1
+        j = bisect_left(owners, (end,))
+        return owners[i:j]
+
+    def owner(self, offset):
+        """Origin tag of the last write to ``offset``, or ``None``."""
+        owners = self._resolve()[0]
+        i = bisect_right(owners, (offset, float("inf"))) - 1
+        if i >= 0 and offset < owners[i][1]:
+            return owners[i][2]
+        return None
@@ -1,36 +1,182 @@
-import struct
+"""IPS patches.
+
+https://zerosoft.zophar.net/ips.php
+
+A patch is the ``PATCH`` magic, a list of records and the ``EOF`` marker.
+Every record is a 24-bit big endian offset followed by either a 16-bit size
+and that many bytes, or a zero size, a 16-bit run length and a single byte
+(RLE). The device's ``ips_patch`` understands the same format, with offsets
+into the headerless ROM.
+"""
+
+from typing import NamedTuple
 
 from .exception import InvalidIPSError
 
+IPS_HEADER = b"PATCH"
+IPS_EOF = b"EOF"
 
-def strip_header(data, shift=-16):
-    """Moves all offsets in IPS data by ``shift``"""
+_EOF_OFFSET = int.from_bytes(IPS_EOF, "big")  # Can't be used as a record offset
+_MAX_OFFSET = 0xFF_FFFF
+_MAX_SIZE = 0xFFFF
+_RECORD_HEADER = 5  # offset + size
+_RLE_RECORD = _RECORD_HEADER + 3  # + run length + value
 
-    data = bytearray(data)
 
-    idx = 0
-    if data[:5] != b"PATCH":
-        raise InvalidIPSError
-    idx += 5
-    while data[idx : idx + 3] != b"EOF":
-        p1, p2 = struct.unpack(">BH", data[idx : idx + 3])
-        p2 = (p1 << 16) | p2
-        p2 += shift
+class Record(NamedTuple):
+    offset: int
+    size: int  # Number of bytes written to the target
+    data: bytes  # ``size`` bytes, or the single repeated byte of an RLE record
+    rle: bool = False
 
-        if p2 < 0:
-            raise NotImplementedError(
-                "Haven't implemented code for patches that change header."
-            )
+    def payload(self):
+        return bytes(self.data) * self.size if self.rle else self.data
+
+
+def iter_records(patch):
+    """Parse and validate ``patch`` one record at a time, without copying.
 
-        p1 = (p2 & (0xFF << 16)) >> 16
-        data[idx : idx + 3] = struct.pack(">B", p1) + struct.pack(">H", p2)
-        idx += 3
+    Yields
+    ------
+    Record
+        ``data`` is a ``memoryview`` into ``patch``.
+    """
+    patch = memoryview(patch).cast("B")
+    if patch[: len(IPS_HEADER)] != IPS_HEADER:
+        raise InvalidIPSError("Missing PATCH header")
 
-        data_len = struct.unpack(">H", data[idx : idx + 2])[0]
-        idx += 2
-        if data_len:
-            idx += data_len
+    idx = len(IPS_HEADER)
+    while True:
+        if patch[idx : idx + len(IPS_EOF)] == IPS_EOF:
+            # Anything after EOF (e.g. the truncation extension) is ignored.
+            return
+        if idx + _RECORD_HEADER > len(patch):
+            raise InvalidIPSError(f"Truncated record at 0x{idx:X} (missing EOF?)")
+
+        offset = int.from_bytes(patch[idx : idx + 3], "big")
+        size = int.from_bytes(patch[idx + 3 : idx + 5], "big")
+        idx += _RECORD_HEADER
+
+        if size:
+            if idx + size > len(patch):
+                raise InvalidIPSError(f"Truncated record data at 0x{idx:X}")
+            yield Record(offset, size, patch[idx : idx + size])
+            idx += size
         else:
+            if idx + 3 > len(patch):
+                raise InvalidIPSError(f"Truncated RLE record at 0x{idx:X}")
+            size = int.from_bytes(patch[idx : idx + 2], "big")
+            yield Record(offset, size, patch[idx + 2 : idx + 3], rle=True)
             idx += 3
 
-    return bytes(data)
+
+def apply(target, patch, shift=0):
+    """Apply ``patch`` in place.
+
+    Parameters
+    ----------
+    target : bytearray
+        Records must not extend past its end.
+    shift : int
+        Added to every record offset, e.g. ``-16`` to apply a patch made for a
+        ``.nes`` file to a headerless ROM. Bytes that end up before the start
+        of ``target`` (i.e. header changes) are dropped.
+
+    Returns
+    -------
+    bytearray
+        ``target``
+    """
+    for record in iter_records(patch):
+        start = record.offset + shift
+        end = start + record.size
+        if end > len(target):
+            raise InvalidIPSError(
+                f"Record 0x{record.offset:X}-0x{record.offset + record.size:X} "
+                f"exceeds the 0x{len(target):X} byte target"
+            )
+        skip = max(0, -start)
+        if skip >= record.size:
+            continue
+        target[start + skip : end] = record.payload()[skip:]
+    return target
+
+
+def encode(records):
+    """Serialize ``records``; records larger than 64KiB are split."""
+    out = bytearray(IPS_HEADER)
+    for record in records:
+        for pos in range(0, record.size, _MAX_SIZE):
+            offset = record.offset + pos
+            size = min(_MAX_SIZE, record.size - pos)
+            if not 0 <= offset <= _MAX_OFFSET or offset == _EOF_OFFSET:
+                raise InvalidIPSError(f"Offset 0x{offset:X} can't be encoded")
+            out += offset.to_bytes(3, "big")
+            if record.rle:
+                out += b"\x00\x00" + size.to_bytes(2, "big") + bytes(record.data)
+            else:
+                out += size.to_bytes(2, "big") + record.data[pos : pos + size]
+    out += IPS_EOF
+    return bytes(out)
+
+
+def _span_records(data, start, end, offset):
+    """Literal and RLE records that write ``data[start:end]``."""
+    records = []
+    literal = i = start
+    while i < end:
+        j = i + 1
+        while j < end and data[j] == data[i]:
+            j += 1
+        # An RLE record in the middle of a literal costs a second literal header.
+        splits = (literal != i) + (j != end)
+        if j - i > _RLE_RECORD - _RECORD_HEADER + splits * _RECORD_HEADER:
+            if literal < i:
+                records.append(
+                    Record(offset + literal, i - literal, bytes(data[literal:i]))
+                )
+            records.append(Record(offset + i, j - i, bytes(data[i : i + 1]), True))
+            literal = j
+        i = j
+    if literal < end:
+        records.append(
+            Record(offset + literal, end - literal, bytes(data[literal:end]))
+        )
+    return records
+
+
+def make_patch(old, new, offset=0):
+    """Compact IPS patch that turns ``old`` into ``new``.
+
+    Parameters
+    ----------
+    offset : int
+        Location of ``old`` in the patched file, e.g. ``0x8000`` for the
+        SMB1 CHR.
+
+    Returns
+    -------
+    bytes
+    """
+    if len(old) != len(new):
+        raise ValueError(f"Length mismatch {len(old)} != {len(new)}")
+
+    spans = []
+    i, n = 0, len(new)
+    while i < n:
+        if old[i] == new[i]:
+            i += 1
+            continue
+        start = i
+        while i < n and old[i] != new[i]:
+            i += 1
+        if spans and start - spans[-1][1] < _RECORD_HEADER:
+            # Rewriting a few unchanged bytes is cheaper than a new record.
+            spans[-1][1] = i
+        else:
+            spans.append([start, i])
+
+    records = []
+    for start, end in spans:
+        records.extend(_span_records(new, start, end, offset))
+    return encode(records)
@@ -1,44 +1,93 @@
 from pathlib import Path
 
-from PIL import Image
-
 import patches
 
 from .compression import lzma_compress
+from .devices import MARIO
 from .exception import BadImageError, InvalidStockRomError
+from .fds import FdsDisk
 from .firmware import Device, ExtFirmware, Firmware, IntFirmware
-from .tileset import bytes_to_tilemap, decode_backdrop, tilemap_to_bytes
 from .utils import (
-    fds_remove_crc_gaps,
     printd,
     printe,
     printi,
-    round_down_word,
     round_up_page,
     seconds_to_frames,
 )
 
 build_dir = Path("build")  # TODO: expose this properly or put in better location
 
+SMB1_ADDR, SMB1_SIZE = 0x1E60, 40960
+SMB1_NES_HEADER = b"NES\x1a\x02\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+SMB1_CHR_START, SMB1_CHR_END = 0x8000, 0x9EC0
+# Raw LZMA streams start with a zero byte, IPS patches with "PATCH".
+SMB1_CHR_XOR_HEADER = b"XCHR"
+
+
+def _headerless_smb1(rom, file_path):
+    if len(rom) == SMB1_SIZE + len(SMB1_NES_HEADER):
+        # Remove the NES header
+        rom = rom[len(SMB1_NES_HEADER) :]
+    if len(rom) != SMB1_SIZE:
+        raise ValueError(f"Unknown length {len(rom)} of file {file_path}")
+    return rom
+
+
+def _smb1_graphics_mod(file_path, rom):
+    """Graphics of a ROM hack, as stored for ``prepare_clock_rom``.
+
+    Only the CHR is used. It's stored as the smallest of
+
+    * an IPS patch against the headerless ``rom``, applied in place;
+    * the LZMA compressed CHR;
+    * ``SMB1_CHR_XOR_HEADER`` and the LZMA compressed XOR with the CHR of
+      ``rom``. Unchanged bytes become runs of zeros, so near-copies of the
+      stock graphics cost little more than what they change.
+    """
+    stock = rom[SMB1_CHR_START:SMB1_CHR_END]
+    data = file_path.read_bytes()
+    suffix = file_path.suffix.lower()
+    if suffix == ".nes":
+        target = _headerless_smb1(data, file_path)
+    elif suffix == ".ips":
+        # Offsets include the NES header.
+        target = patches.ips.apply(bytearray(rom), data, shift=-len(SMB1_NES_HEADER))
+    elif suffix == ".bps":
+        source = rom
+        if patches.bps.parse_header(data).source_size != len(rom):
+            source = SMB1_NES_HEADER + rom
+        target = _headerless_smb1(patches.bps.apply(source, data), file_path)
+    else:
+        raise ValueError(f"Don't know how to handle extension for {file_path}.")
+
+    graphics = bytes(target[SMB1_CHR_START:SMB1_CHR_END])
+    delta = patches.ips.make_patch(stock, graphics, offset=SMB1_CHR_START)
+    compressed = lzma_compress(graphics)
+    xor = int.from_bytes(stock, "little") ^ int.from_bytes(graphics, "little")
+    xor_compressed = SMB1_CHR_XOR_HEADER + lzma_compress(
+        xor.to_bytes(len(graphics), "little")
+    )
+    printd(
+        f"{file_path.name}: {len(delta)} byte IPS delta, "
+        f"{len(compressed)} byte compressed CHR, "
+        f"{len(xor_compressed)} byte compressed XOR delta"
+    )
+    return min(delta, compressed, xor_compressed, key=len)
+
 
 class MarioGnW(Device, name="mario"):
     class Int(IntFirmware):
-        STOCK_ROM_SHA1_HASH = "efa04c387ad7b40549e15799b471a6e1cd234c76"
-
-        # Note: this isn't the ACTUAL Stock ROM end, this is actually
-        # pointing to where some rwdata is, but this data will be relocated
-        # and compressed. This variable is used in the linker scripts as to
-        # where to start putting novel code.
-        STOCK_ROM_END = 0x18100
-        KEY_OFFSET = 0x106F4
-        NONCE_OFFSET = 0x106E4
+        STOCK_ROM_SHA1_HASH = MARIO.int_sha1
+        STOCK_ROM_END = MARIO.stock_rom_end
+        KEY_OFFSET = MARIO.key_offset
+        NONCE_OFFSET = MARIO.nonce_offset
         RWDATA_OFFSET = 0x180A4
         RWDATA_LEN = 36
         RWDATA_ITCM_IDX = 0
         RWDATA_DTCM_IDX = 1
 
     class Ext(ExtFirmware):
-        STOCK_ROM_SHA1_HASH = "eea70bb171afece163fb4b293c5364ddb90637ae"
+        STOCK_ROM_SHA1_HASH = MARIO.ext_sha1
         ENC_END = 0xF_E000
 
         def _verify(self):
@@ -50,7 +99,9 @@ class MarioGnW(Device, name="mario"):
         FLASH_BASE = 0x240F2124
         FLASH_LEN = 0x24100000 - FLASH_BASE
 
-    def argparse(self, parser):
+    @classmethod
+    def argparse(cls, parser):
+        """Add device-specific arguments, then parse and validate all arguments."""
         group = parser.add_argument_group("Timeout patches")
 
         mgroup = group.add_mutually_exclusive_group()
@@ -83,8 +134,7 @@ class MarioGnW(Device, name="mario"):
         group.add_argument(
             "--smb1",
             type=Path,
-            default="build/smb1.nes",
-            help="Override SMB1 ROM with your own file.",
+            help="Override SMB1 ROM with your own file. Defaults to the stock ROM.",
         )
         mgroup = group.add_mutually_exclusive_group()
         mgroup.add_argument(
@@ -92,12 +142,12 @@ class MarioGnW(Device, name="mario"):
             nargs="*",
             default=[],
             type=Path,
-            help="ROM hacks where just the graphical assets will be used.",
+            help="ROM hacks (.ips, .bps or .nes) where just the graphical assets will be used.",
         )
         mgroup.add_argument(
             "--smb1-graphics-glob",
             action="store_true",
-            help='Add all IPS files from the "ips/" folder',
+            help='Add all IPS and BPS files from the "ips/" folder',
         )
 
         mgroup = group.add_mutually_exclusive_group()
@@ -156,46 +206,64 @@ class MarioGnW(Device, name="mario"):
             help="Configuration so no external flash is used.",
         )
 
-        self.args = parser.parse_args()
+        args = parser.parse_args()
 
         ############
         # Validate #
         ############
-        if self.args.sleep_time and (
-            self.args.sleep_time < 1 or self.args.sleep_time > 1092
-        ):
+        if args.sleep_time and (args.sleep_time < 1 or args.sleep_time > 1092):
             parser.error("--sleep-time must be in range [1, 1092]")
-        if self.args.mario_song_time and (
-            self.args.mario_song_time < 1 or self.args.mario_song_time > 1092
+        if args.mario_song_time and (
+            args.mario_song_time < 1 or args.mario_song_time > 1092
         ):
             parser.error("--mario_song-time must be in range [1, 1092]")
 
-        if len(self.args.smb1_graphics) > 8:
+        if args.smb1_graphics_glob:
+            ips_folder = Path("ips")
+            args.smb1_graphics = sorted(
+                x for x in ips_folder.glob("*") if x.suffix.lower() in (".ips", ".bps")
+            )
+
+        if len(args.smb1_graphics) > 8:
             parser.error("A maximum of 8 SMB1 graphics mods can be specified.")
 
-        if self.args.smb1_graphics_glob:
-            ips_folder = Path("ips")
-            self.args.smb1_graphics = list(ips_folder.glob("*.ips"))
-            self.args.smb1_graphics.extend(list(ips_folder.glob("*.IPS")))
+        if args.internal_only:
+            args.slim = True
+            args.extended = True
+            args.no_save = True
+            if args.sd_bootloader:
+                args.no_smb2 = True
 
-        if self.args.internal_only:
-            self.args.slim = True
-            self.args.extended = True
-            self.args.no_save = True
-            if self.args.sd_bootloader:
-                self.args.no_smb2 = True
+        if args.clock_only:
+            args.slim = True
+            args.no_smb2 = True
 
-        if self.args.clock_only:
-            self.args.slim = True
-            self.args.no_smb2 = True
+        if args.slim:
+            args.no_mario_song = True
+            args.no_sleep_images = True
 
-        if self.args.slim:
-            self.args.no_mario_song = True
-            self.args.no_sleep_images = True
+        return args
 
-        return self.args
+    def _smb1_rom(self):
+        """Headerless SMB1 ROM that ends up on the device."""
+        if self.args.smb1 is None:
+            return bytes(self.external[SMB1_ADDR : SMB1_ADDR + SMB1_SIZE])
+        return _headerless_smb1(self.args.smb1.read_bytes(), self.args.smb1)
 
     def patch(self):
+        from PIL import Image
+
+        from .tileset import (
+            PALETTE_NAMES,
+            PALETTE_OFFSETS,
+            bytes_to_canvas,
+            bytes_to_tilemap,
+            canvas_to_tilemap,
+            decode_backdrops,
+            render_palettes,
+            tilemap_to_bytes,
+        )
+
         printi("Invoke custom bootloader prior to calling stock Reset_Handler.")
         self.internal.replace(0x4, "bootloader")
 
@@ -237,15 +305,29 @@ class MarioGnW(Device, name="mario"):
             self.internal.nop(0x10688, 2)
             self.internal.nop(0x1068E, 1)
 
-        # Dump the tileset
+        # Dump the tileset with every clock palette
         tileset_addr, tileset_size = 0x9_8B84, 0x1_0000
         palette_addr = 0xB_EC68
         palette = self.external[palette_addr : palette_addr + 320]
         tileset_bytes = self.external[tileset_addr : tileset_addr + tileset_size]
-        tileset = bytes_to_tilemap(tileset_bytes, palette=palette)
-        tileset.save(build_dir / "tileset.png")
-        tileset_index = bytes_to_tilemap(tileset_bytes)
-        tileset_index.save(build_dir / "tileset_index.png")
+        # tileset.png stays palettized for editing; the previews are RGB.
+        palettes = [self.external[x : x + 320] for x in PALETTE_OFFSETS[1:]]
+
+        def render_tilesets():
+            canvas = bytes_to_canvas(tileset_bytes)
+            return (
+                [canvas_to_tilemap(canvas, palette)]
+                + [Image.fromarray(x, "RGB") for x in render_palettes(canvas, palettes)]
+                + [canvas_to_tilemap(canvas)]
+            )
+
+        self.dump_many(
+            [build_dir / "tileset.png"]
+            + [build_dir / f"tileset_{x}.png" for x in PALETTE_NAMES[1:]]
+            + [build_dir / "tileset_index.png"],
+            render_tilesets,
+            group="graphics",
+        )
 
         # Override tileset
         if self.args.clock_tileset:
@@ -267,12 +349,12 @@ class MarioGnW(Device, name="mario"):
         iconset_addr, iconset_size = 0xAACE4, 0x3F00
         palette_addr = 0xB_EC68
         palette = self.external[palette_addr : palette_addr + 320]
-        iconset = bytes_to_tilemap(
-            self.external[iconset_addr : iconset_addr + iconset_size],
-            palette=palette,
-            bpp=4,
+        iconset_bytes = self.external[iconset_addr : iconset_addr + iconset_size]
+        self.dump(
+            build_dir / "iconset.png",
+            lambda: bytes_to_tilemap(iconset_bytes, palette=palette, bpp=4),
+            group="graphics",
         )
-        iconset.save(build_dir / "iconset.png")
 
         # Override iconset
         # with Image.open(self.args.iconset) as iconset:
@@ -302,56 +384,41 @@ class MarioGnW(Device, name="mario"):
             self.internal.nop(0x1_0EF0, 2)
 
             table = self.internal.address("SMB1_GRAPHIC_MODS", sub_base=True)
+            rom = self._smb1_rom()
+            locs = {}  # Identical mods share their data
             for file_path in self.args.smb1_graphics:
-                if file_path.suffix.lower() == ".nes":
-                    rom = file_path.read_bytes()
-                    if len(rom) == 40976:
-                        # Remove the NES header
-                        rom = rom[16:]
-                    assert len(rom) == 40960
-                    graphics = rom[0x8000:0x9EC0]
-                    graphics_compressed = lzma_compress(graphics)
-                    loc = self.move_to_int(
-                        graphics_compressed, len(graphics_compressed), None
-                    )
-                    loc += self.internal.FLASH_BASE
-                elif file_path.suffix.lower() == ".ips":
-                    patch = file_path.read_bytes()
-                    patch = patches.ips.strip_header(patch)
-                    loc = self.move_to_int(patch, len(patch), None)
-                    loc += self.internal.FLASH_BASE
-                else:
-                    raise ValueError(
-                        f"Don't know how to handle extension for {file_path}."
-                    )
+                mod = _smb1_graphics_mod(file_path, rom)
+                if mod not in locs:
+                    locs[mod] = self.move_to_int(mod, len(mod), None)
+                    locs[mod] += self.internal.FLASH_BASE
+                loc = locs[mod]
                 # Update the SMB1_GRAPHIC_MODS table
                 self.internal.replace(table, loc, size=4)
                 table += 4
+            printi(
+                f"{len(self.args.smb1_graphics)} SMB1 graphics mods use "
+                f"{sum(len(x) for x in locs)} bytes of internal flash"
+            )
 
         printd("Compressing and moving stuff stuff to internal firmware.")
         compressed_len = self.external.compress(
             0x0, 7772
         )  # Dst expects only 7772 bytes, not 7776
         self.internal.bl(0x665C, "memcpy_inflate")
-        self.move_ext(0x0, compressed_len, 0x7204)
         # Note: the 4 bytes between 7772 and 7776 is padding.
-        self.ext_offset -= 7776 - round_down_word(compressed_len)
+        self.free_ext(compressed_len, 7776 - compressed_len)
+        self.move_ext(0x0, compressed_len, 0x7204)
 
         # SMB1 ROM (plus loading custom ROM)
         printd("Compressing and moving SMB1 ROM to compressed_memory.")
-        smb1_addr, smb1_size = 0x1E60, 40960
+        smb1_addr, smb1_size = SMB1_ADDR, SMB1_SIZE
         # Adding the header for patching convenience.
-        (build_dir / "smb1.nes").write_bytes(
-            b"NES\x1a\x02\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            + self.external[smb1_addr : smb1_addr + smb1_size]
+        self.dump(
+            build_dir / "smb1.nes",
+            lambda: SMB1_NES_HEADER + self.external[smb1_addr : smb1_addr + smb1_size],
+            group="roms",
         )
-        smb1 = self.args.smb1.read_bytes()
-        if len(smb1) == 40976:
-            # Remove the NES header
-            smb1 = smb1[16:]
-        if len(smb1) != smb1_size:
-            raise ValueError(f"Unknown length {len(smb1)} of file {self.args.smb1}")
-        self.external[smb1_addr : smb1_addr + smb1_size] = smb1
+        self.external[smb1_addr : smb1_addr + smb1_size] = self._smb1_rom()
         patch_smb1_refr = self.internal.address("SMB1_ROM", sub_base=True)
         self.move_to_compressed_memory(
             smb1_addr, smb1_size, [0x7368, 0x10954, 0x7218, patch_smb1_refr]
@@ -441,9 +508,8 @@ class MarioGnW(Device, name="mario"):
         if self.args.no_mario_song:
             # This isn't really necessary, but we keep it here because its more explicit.
             printe("Erasing Mario Song")
-            self.external.replace(0x1_2D44, b"\x00" * mario_song_len)
+            self.free_ext(0x1_2D44, mario_song_len)
             self.rwdata_erase(0x1_2D44, mario_song_len)
-            self.ext_offset -= mario_song_len
 
             self.internal.asm(0x6FC8, "b 0x1c")
         else:
@@ -469,8 +535,8 @@ class MarioGnW(Device, name="mario"):
         self.internal.bl(0x678E, "memcpy_inflate")
 
         printe("Moving clock graphics")
+        self.free_ext(0x9_8B84 + compressed_len, 0x1_0000 - compressed_len)
         self.move_ext(0x9_8B84, compressed_len, 0x7350)
-        self.ext_offset -= 0x1_0000 - round_down_word(compressed_len)
 
         # Note: the clock uses a different palette; this palette only applies
         # to ingame Super Mario Bros 1 & 2
@@ -498,18 +564,15 @@ class MarioGnW(Device, name="mario"):
 
         # Dump a playable version of SMB2
         smb2_addr, smb2_size = 0xA_EC58, 0x1_0000
-        smb2_end = smb2_addr + smb2_size
-        smb2 = self.external[smb2_addr:smb2_end].copy()
-        smb2 = fds_remove_crc_gaps(smb2)
-        (build_dir / "smb2.fds").write_bytes(smb2)
+        self.dump(
+            build_dir / "smb2.fds",
+            lambda: FdsDisk.from_gapped(self.external, [smb2_addr]).to_bytes(),
+            group="roms",
+        )
 
         if self.args.no_smb2:
             printe("Erasing SMB2 ROM")
-            self.external.replace(
-                smb2_addr,
-                b"\x00" * smb2_size,
-            )
-            self.ext_offset -= smb2_size
+            self.free_ext(smb2_addr, smb2_size)
 
             # Replace conditional-branch with unconditional
             # TODO: this prevents hardlocking when selecting SMB2 from the menu,
@@ -519,10 +582,8 @@ class MarioGnW(Device, name="mario"):
             printe("Compressing and moving SMB2 ROM.")
             compressed_len = self.external.compress(smb2_addr, smb2_size)
             self.internal.bl(0x6A12, "memcpy_inflate")
+            self.free_ext(smb2_addr + compressed_len, smb2_size - compressed_len)
             self.move_to_compressed_memory(smb2_addr, compressed_len, 0x7374)
-            self.ext_offset -= smb2_size - round_down_word(
-                compressed_len
-            )  # Move by the space savings.
 
             # Round to nearest page so that the length can be used as an imm
             compressed_len = round_up_page(compressed_len)
@@ -646,15 +707,18 @@ class MarioGnW(Device, name="mario"):
             0x1097C + 12,
             0x1097C + 16,
         ]
-        for name, index in [
+        backdrops = [
             ("mario_sleeping", 0xC_58F8),
             ("mario_juggling", 0xC_D858),
             ("bowser_sleeping", 0xD_6C78),
             ("pizza", 0xE_16F8),
             ("minions_sleeping", 0xE_C318),
-        ]:
-            img, _ = decode_backdrop(self.external[index:])
-            img.save(build_dir / f"backdrop_{name}.png")
+        ]
+        self.dump_many(
+            [build_dir / f"backdrop_{name}.png" for name, _ in backdrops],
+            lambda: decode_backdrops(self.external, [x for _, x in backdrops]),
+            group="graphics",
+        )
 
         if self.args.no_sleep_images:
             # Images Notes:
@@ -668,11 +732,16 @@ class MarioGnW(Device, name="mario"):
             #          zero_padded_end: 0x900f_4d18
             # Total Image Length: 193_568 bytes
             printe("Deleting sleeping images.")
-            self.external.replace(0xC58F8, b"\x00" * total_image_length)
+            self.free_ext(0xC58F8, total_image_length)
             for reference in references:
                 self.internal.replace(reference, b"\x00" * 4)  # Erase image references
-            self.ext_offset -= total_image_length
         else:
+            if not self.args.no_recompress_images:
+                printi("Recompressing sleeping images.")
+                total_image_length = self.recompress_backdrops(
+                    backdrops, 0xC58F8 + total_image_length
+                )
+                self.internal.lookup(references)
             self.move_ext(0xC58F8, total_image_length, references)
 
         # Definitely at least contains part of the TIME graphic on startup screen.
@@ -680,8 +749,7 @@ class MarioGnW(Device, name="mario"):
 
         # What is this data?
         # The memcpy to this address is all zero, so i guess its not used?
-        self.external.replace(0xF5858, b"\x00" * 34728)  # refence at internal 0x7210
-        self.ext_offset -= 34728
+        self.free_ext(0xF5858, 34728)  # refence at internal 0x7210
 
         if self.compressed_memory_pos:
             # Compress and copy over compressed_memory
@@ -695,42 +763,43 @@ class MarioGnW(Device, name="mario"):
             0x17DB4, data_offset=self.int_pos
         )
 
-        # Shorten the external firmware
-        # This rounds the negative self.ext_offset towards zero.
-        self.ext_offset = round_up_page(self.ext_offset)
+        # Shorten the external firmware to the last used page.
+        # The NVRAM (last 2 pages of the stock external flash) goes right after.
+        self.ext_alloc.free(0xF_E000, 8192)
+        ext_end = round_up_page(self.ext_alloc.high_water_mark)
 
         if self.args.no_save:
             # Disable nvram loading
-            for nop in [0x495E, 0x49A6, 0x49B2]:
-                self.internal.nop(nop, 2)
+            self.internal.nop_many([0x495E, 0x49A6, 0x49B2], 2)
             # self.internal.b(0x4988, 0x49be)  # If you still want the first-startup "Press TIME Button" screen
             self.internal.b(0x4988, 0x49C0)  # Skips Press TIME Button screen
 
             # Disable nvram saving
             # This just skips the body of the nvram_write_bank function
             self.internal.b(0x48BE, 0x4912)
-
-            self.ext_offset -= 8192
         else:
+            nvram = ext_end
+            ext_end += 8192
             printi("Update NVRAM read addresses")
             self.internal.asm(
                 0x4856,
                 "ite ne; "
-                f"movne.w r4, #{hex(0xff000 + self.ext_offset)}; "
-                f"moveq.w r4, #{hex(0xfe000 + self.ext_offset)}",
+                f"movne.w r4, #{hex(nvram + 0x1000)}; "
+                f"moveq.w r4, #{hex(nvram)}",
             )
             printi("Update NVRAM write addresses")
             self.internal.asm(
                 0x48C0,
                 "ite ne; "
-                f"movne.w r4, #{hex(0xff000 + self.ext_offset)}; "
-                f"moveq.w r4, #{hex(0xfe000 + self.ext_offset)}",
+                f"movne.w r4, #{hex(nvram + 0x1000)}; "
+                f"moveq.w r4, #{hex(nvram)}",
             )
 
         # Finally, shorten the firmware
         printi("Updating end of OTFDEC pointer")
-        self.internal.add(0x1_06EC, self.ext_offset)
-        self.external.shorten(self.ext_offset)
+        ext_offset = ext_end - len(self.external)
+        self.internal.add(0x1_06EC, ext_offset)
+        self.external.shorten(ext_offset)
 
         internal_remaining_free = len(self.internal) - self.int_pos
         compressed_memory_free = (
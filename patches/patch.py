@@ -1,11 +1,15 @@
-import inspect
+import atexit
 import json
+import re
+import struct
 from contextlib import suppress
 from pathlib import Path
 
+from . import thumb
+from .cache import atomic_write_bytes, file_lock
 from .compact_json_encoder import CompactJSONEncoder
 from .compression import lzma_compress
-from .exception import InvalidAsmError
+from .exception import InvalidAsmError, UnsupportedAsmError
 
 
 def twos_compliment(value, bits):
@@ -16,47 +20,203 @@ def twos_compliment(value, bits):
         return (1 << bits) + value
 
 
+_BRANCH_RE = re.compile(
+    r"^(b(?:l|eq|ne|cs|hs|cc|lo|mi|pl|vs|vc|hi|ls|ge|lt|gt|le)?(?:\.w|\.n)?)"
+    r"\s+#?(0x[0-9a-f]+|\d+)$"
+)
+_PC_RELATIVE_MNEMONICS = ("b", "bl", "blx", "bx", "cbz", "cbnz", "adr", "tbb", "tbh")
+_CONDITIONS = "eq ne cs hs cc lo mi pl vs vc hi ls ge lt gt le al".split()
+
+
+def _normalize_asm(string):
+    """Canonical whitespace/case for an assembly string."""
+    string = string.strip().lower()
+    string = re.sub(r"\s*;\s*", "; ", string)
+    string = re.sub(r"\s*,\s*", ", ", string)
+    string = re.sub(r"\s+", " ", string)
+    return string
+
+
+def _is_position_dependent(string):
+    for instruction in string.split(";"):
+        mnemonic, _, operands = instruction.strip().partition(" ")
+        mnemonic = mnemonic.split(".")[0]
+        if mnemonic in _PC_RELATIVE_MNEMONICS:
+            return True
+        if mnemonic[:1] == "b" and mnemonic[1:] in _CONDITIONS:
+            return True
+        if re.search(r"\bpc\b", operands) or "=" in operands:
+            return True
+    return False
+
+
+def keystone_cache_key(string, addr=0):
+    """Cache key for ``Ks.asm(string, addr)``.
+
+    Position-independent instructions don't include the address, and single
+    immediate branches are keyed by their displacement, so the same
+    instruction at different addresses shares an entry.
+    """
+    string = _normalize_asm(string)
+
+    match = _BRANCH_RE.match(string)
+    if match:
+        mnemonic, target = match.groups()
+        return f"{mnemonic} .{int(target, 0) - addr:+#x}"
+
+    if addr and _is_position_dependent(string):
+        return f"{string} @0x{addr:08x}"
+
+    return string
+
+
 class CachedKeystone:
-    def __init__(self, path="patches/keystone_cache.json"):
+    """Keystone assembler with a persistent cache.
+
+    End users typically don't have keystone installed, so all encodings are
+    stored in the committed ``patches/keystone_cache.json``. A packed binary
+    copy in ``build/`` is used for fast loading.
+
+    Cache misses are only written to disk once via ``flush`` (registered with
+    ``atexit``) with an atomic rename while holding a file lock, so concurrent
+    builds don't clobber each other.
+    """
+
+    BIN_MAGIC = b"GWKS"
+    BIN_VERSION = 1
+
+    def __init__(
+        self,
+        path="patches/keystone_cache.json",
+        bin_path="build/keystone_cache.bin",
+        lock_path="build/keystone_cache.lock",
+    ):
         self.path = Path(path)
+        self.bin_path = Path(bin_path)
+        self.lock_path = Path(lock_path)
 
         self._ks = None
-        from keystone import KS_ARCH_ARM, KS_MODE_THUMB, Ks
+        self._pending = {}
 
-        self._ks = Ks(KS_ARCH_ARM, KS_MODE_THUMB)
-        self._sig = inspect.signature(self._ks.asm)
+        if self._bin_is_fresh():
+            self._cache = self._read_bin(self.bin_path)
+        else:
+            self._cache = self._read_json(self.path)
+            if self._cache:
+                # Create/refresh the binary copy for the next run.
+                with suppress(OSError), file_lock(self.lock_path):
+                    atomic_write_bytes(self.bin_path, self._pack(self._cache))
 
-        self._cache = {}
-        with suppress(FileNotFoundError):
-            with self.path.open("r") as f:
-                self._cache = json.load(f)
+        atexit.register(self.flush)
 
-    def asm(self, *args, **kwargs):
-        key = str(args) + json.dumps(kwargs, sort_keys=True)
+    def _bin_is_fresh(self):
+        try:
+            bin_mtime = self.bin_path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        try:
+            return bin_mtime >= self.path.stat().st_mtime
+        except FileNotFoundError:
+            return True
+
+    @staticmethod
+    def _read_json(path):
+        with suppress(FileNotFoundError):
+            with path.open("r") as f:
+                return json.load(f)
+        return {}
+
+    @classmethod
+    def _pack(cls, cache):
+        """Packed binary representation.
+
+        Format
+        ------
+        4     Magic ``GWKS``
+        2     Version
+        4     Number of entries
+        Then for each entry:
+            2     Key length
+            2     Encoding length
+            N     Key (utf-8)
+            M     Encoding
+        """
+        out = [cls.BIN_MAGIC, struct.pack("<HI", cls.BIN_VERSION, len(cache))]
+        for key, encoding in sorted(cache.items()):
+            key = key.encode()
+            out.append(struct.pack("<HH", len(key), len(encoding)))
+            out.append(key)
+            out.append(bytes(encoding))
+        return b"".join(out)
+
+    @classmethod
+    def _read_bin(cls, path):
+        cache = {}
+        with suppress(FileNotFoundError):
+            data = memoryview(path.read_bytes())
+            if data[:4] != cls.BIN_MAGIC:
+                return cache
+            version, n_entries = struct.unpack_from("<HI", data, 4)
+            if version != cls.BIN_VERSION:
+                return cache
+            idx = 10
+            for _ in range(n_entries):
+                key_len, enc_len = struct.unpack_from("<HH", data, idx)
+                idx += 4
+                key = bytes(data[idx : idx + key_len]).decode()
+                idx += key_len
+                cache[key] = list(data[idx : idx + enc_len])
+                idx += enc_len
+        return cache
+
+    def asm(self, string, addr=0):
+        key = keystone_cache_key(string, addr)
         with suppress(KeyError):
             return self._cache[key]
 
         if self._ks is None:
-            raise RuntimeError(
-                "Un-cached instruction, and keystone is not installed. "
-                "If you are an end-user, please open up a github issue or report this in the discord. "
-                "If you are a developer, please pip install keystone-engine."
-            )
+            try:
+                from keystone import KS_ARCH_ARM, KS_MODE_THUMB, Ks
+            except ImportError:
+                raise RuntimeError(
+                    "Un-cached instruction, and keystone is not installed. "
+                    "If you are an end-user, please open up a github issue or report this in the discord. "
+                    "If you are a developer, please pip install keystone-engine."
+                ) from None
+            self._ks = Ks(KS_ARCH_ARM, KS_MODE_THUMB)
 
-        value = self._ks.asm(*args, **kwargs)[0]
+        value = self._ks.asm(string, addr)[0]
 
         if value is None:
             raise InvalidAsmError
 
         self._cache[key] = value
+        self._pending[key] = value
+
+        return value
 
-        self.path.parent.mkdir(exist_ok=True, parents=True)
-        with self.path.open("w") as f:
-            json.dump(
-                self._cache, f, sort_keys=True, indent="\t", cls=CompactJSONEncoder
+    def flush(self):
+        """Merge cache misses into the on-disk caches."""
+        if not self._pending:
+            return
+
+        with file_lock(self.lock_path):
+            # Another build may have added entries since we loaded.
+            cache = self._read_json(self.path)
+            cache.update(self._pending)
+
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            atomic_write_bytes(
+                self.path,
+                json.dumps(
+                    cache, sort_keys=True, indent="\t", cls=CompactJSONEncoder
+                ).encode()
+                + b"\n",
             )
+            atomic_write_bytes(self.bin_path, self._pack(cache))
 
-        return value
+        self._cache.update(cache)
+        self._pending.clear()
 
 
 class FirmwarePatchMixin:
@@ -133,7 +293,7 @@ class FirmwarePatchMixin:
         pc = offset + 4
         jump = data - pc
 
-        if abs(jump) > (2 * (1 << 10)):
+        if not -2048 <= jump <= 2046:
             # Max +-2KB jump
             raise ValueError(f"Too large of a jump {jump} specified.")
 
@@ -168,14 +328,13 @@ class FirmwarePatchMixin:
             raise ValueError(f"Too large of a jump {jump} specified.")
 
         # Where H=0
-        offset_stage_1 = jump >> 12
-        offset_stage_1 = twos_compliment(offset_stage_1, 11)
+        offset_stage_1 = twos_compliment(jump >> 12, 11)
 
         stage_1_byte_0 = 0b1111_0000 | ((offset_stage_1 >> 8) & 0x7)
         stage_1_byte_1 = offset_stage_1 & 0xFF
 
         # Where H=1
-        offset_stage_2 = (jump - (offset_stage_1 << 12)) >> 1
+        offset_stage_2 = (jump - ((jump >> 12) << 12)) >> 1
         if offset_stage_2 >> 11:
             raise ValueError(f"bl jump 0x{jump:08X} too large!")
 
@@ -190,6 +349,19 @@ class FirmwarePatchMixin:
 
         return 4
 
+    def _write_many(self, sites, encoding):
+        import numpy as np
+
+        # The view must be released before the bytearray can be resized again.
+        view = np.frombuffer(self, dtype=np.uint8)
+        view[sites[:, None] + np.arange(encoding.shape[1])] = encoding
+        del view
+
+        # Bypassed ``Firmware.__setitem__``
+        for site in sites.tolist():
+            self.record_write(site, site + encoding.shape[1])
+        return encoding.size
+
     def bkpt(self, offset, size=2):
         """Insert software breakpoint(s)"""
         if size % 2:
@@ -199,13 +371,14 @@ class FirmwarePatchMixin:
         self[offset : offset + size] = b"\x00\xbe" * n_bkpts
         return size
 
+    _ks_inst = None
+
     @property
     def _ks(self):
-        try:
-            return self._ks_inst
-        except AttributeError:
-            self._ks_inst = CachedKeystone()
-        return self._ks_inst
+        # Shared by all firmware instances so the cache is loaded/flushed once.
+        if FirmwarePatchMixin._ks_inst is None:
+            FirmwarePatchMixin._ks_inst = CachedKeystone()
+        return FirmwarePatchMixin._ks_inst
 
     def asm(self, offset: int, data: str, size=None) -> int:
         """
@@ -216,9 +389,13 @@ class FirmwarePatchMixin:
         """
         data = data.strip()
         if data.startswith(("b.w")):
-            encoding = self._ks.asm(data, self.FLASH_BASE + offset)
+            addr = self.FLASH_BASE + offset
         else:
-            encoding = self._ks.asm(data)
+            addr = 0
+        try:
+            encoding = thumb.assemble(data, addr)
+        except UnsupportedAsmError:
+            encoding = self._ks.asm(data, addr)
         print(f'    "{data}" -> {[hex(x) for x in encoding]}')
         if size:
             assert len(encoding) == size
@@ -232,6 +409,23 @@ class FirmwarePatchMixin:
         self[offset : offset + size] = b"\x00\xbf" * data
         return size
 
+    def nop_many(self, offsets, data: int) -> int:
+        """Insert ``data`` NOP operations at each of ``offsets``."""
+        import numpy as np
+
+        offsets = np.asarray(list(offsets), dtype=np.int64)
+        size = data * 2
+        bad = (offsets < 0) | (offsets + size > len(self))
+        if bad.any():
+            raise ValueError(
+                "nop offset(s) out of range: "
+                + ", ".join(f"0x{x:08X}" for x in offsets[bad])
+            )
+        encoding = np.tile(np.frombuffer(b"\x00\xbf", dtype=np.uint8), data)
+        return self._write_many(
+            offsets, np.broadcast_to(encoding, (len(offsets), size))
+        )
+
     def _move_copy(self, offset: int, data: int, size: int, delete: bool) -> int:
         """Move from offset -> data"""
 
@@ -0,0 +1,71 @@
+"""Symbol table of the compiled patch ELF.
+
+Parsing ``.symtab`` with pyelftools is slow, so it's parsed once into a dict
+and saved next to the ELF keyed by the ELF's SHA1. Subsequent runs with the
+same ELF don't touch pyelftools at all.
+"""
+
+import json
+from contextlib import suppress
+from pathlib import Path
+from typing import NamedTuple
+
+from .cache import atomic_write_bytes, file_sha1
+
+
+class Symbol(NamedTuple):
+    value: int
+    size: int
+    type: str  # e.g. "STT_FUNC", "STT_OBJECT"
+
+
+class SymbolIndex(dict):
+    """Mapping of symbol name -> ``Symbol``.
+
+    If a name occurs multiple times, the first entry in ``.symtab`` is used.
+    """
+
+    VERSION = 1
+
+    @staticmethod
+    def cache_path(elf):
+        elf = Path(elf)
+        return elf.with_name(elf.name + ".symbols.json")
+
+    @classmethod
+    def from_elf(cls, elf):
+        from elftools.elf.elffile import ELFFile
+
+        index = cls()
+        with open(elf, "rb") as f:
+            symtab = ELFFile(f).get_section_by_name(".symtab")
+            if symtab is None:
+                return index
+            for symbol in symtab.iter_symbols():
+                if not symbol.name or symbol.name in index:
+                    continue
+                index[symbol.name] = Symbol(
+                    symbol["st_value"], symbol["st_size"], symbol["st_info"]["type"]
+                )
+        return index
+
+    @classmethod
+    def load(cls, elf):
+        """Load from the on-disk cache, re-parsing the ELF if it changed."""
+        cache_path = cls.cache_path(elf)
+        sha1 = file_sha1(elf)
+
+        with suppress(FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+            cached = json.loads(cache_path.read_text())
+            if cached["version"] == cls.VERSION and cached["sha1"] == sha1:
+                return cls((k, Symbol(*v)) for k, v in cached["symbols"].items())
+
+        index = cls.from_elf(elf)
+        with suppress(OSError):
+            atomic_write_bytes(
+                cache_path,
+                json.dumps(
+                    {"version": cls.VERSION, "sha1": sha1, "symbols": index}
+                ).encode(),
+            )
+        return index
@@ -0,0 +1,284 @@
+"""Minimal Thumb-2 assembler for the instructions used by the device patches.
+
+Most end users don't have the native keystone library installed, so any
+parameter change (e.g. ``--sleep-time``) would otherwise be an un-cached
+instruction. This covers the handful of instructions the patches actually
+use; ``assemble`` raises ``UnsupportedAsmError`` for anything else so the
+caller can fall back to keystone.
+
+Supported::
+
+    mov    rd, rm                 (16-bit)
+    movw   rd, #imm16
+    mov.w  rd, #const             (modified immediate)
+    cmp.w  rn, #const
+    add.w  rd, rn, #const
+    sub.w  rd, rn, #const
+    add    sp, #imm / sub sp, #imm
+    b      target                 (16-bit)
+    b.w    target
+    it{x{y{z}}} cond              (followed by conditional versions of the above)
+    nop
+"""
+
+import re
+from functools import lru_cache
+
+from .exception import UnsupportedAsmError
+
+CONDITIONS = {
+    "eq": 0x0,
+    "ne": 0x1,
+    "cs": 0x2,
+    "hs": 0x2,
+    "cc": 0x3,
+    "lo": 0x3,
+    "mi": 0x4,
+    "pl": 0x5,
+    "vs": 0x6,
+    "vc": 0x7,
+    "hi": 0x8,
+    "ls": 0x9,
+    "ge": 0xA,
+    "lt": 0xB,
+    "gt": 0xC,
+    "le": 0xD,
+}
+
+REGISTERS = {
+    **{f"r{i}": i for i in range(16)},
+    "sb": 9,
+    "sl": 10,
+    "fp": 11,
+    "ip": 12,
+    "sp": 13,
+    "lr": 14,
+    "pc": 15,
+}
+
+SP, PC = 13, 15
+
+_MNEMONIC_RE = re.compile(
+    r"^([a-z]+?)(eq|ne|cs|hs|cc|lo|mi|pl|vs|vc|hi|ls|ge|lt|gt|le)?$"
+)
+_BASE_MNEMONICS = ("mov", "movw", "cmp", "add", "sub", "b", "nop")
+
+
+@lru_cache(maxsize=None)
+def modified_immediate_table():
+    """Mapping of every ThumbExpandImm-encodable constant to its ``i:imm3:imm8``."""
+    table = {}
+    for xy in range(0x100):
+        table.setdefault(xy, xy)
+    for xy in range(1, 0x100):
+        table.setdefault(xy | (xy << 16), 0x100 | xy)
+        table.setdefault((xy << 8) | (xy << 24), 0x200 | xy)
+        table.setdefault(xy * 0x0101_0101, 0x300 | xy)
+    for rotation in range(8, 32):
+        for x in range(0x80, 0x100):
+            value = ((x >> rotation) | (x << (32 - rotation))) & 0xFFFF_FFFF
+            table.setdefault(value, (rotation << 7) | (x & 0x7F))
+    return table
+
+
+def _register(token, allow_sp=False, allow_pc=False):
+    try:
+        reg = REGISTERS[token]
+    except KeyError:
+        raise UnsupportedAsmError(f'Unknown register "{token}"') from None
+    if (reg == SP and not allow_sp) or (reg == PC and not allow_pc):
+        raise UnsupportedAsmError(f'Register "{token}" not supported here')
+    return reg
+
+
+def _immediate(token):
+    token = token.lstrip("#")
+    try:
+        return int(token, 0)
+    except ValueError:
+        raise UnsupportedAsmError(f'Cannot parse immediate "{token}"') from None
+
+
+def _modified_immediate(value):
+    try:
+        return modified_immediate_table()[value]
+    except KeyError:
+        raise UnsupportedAsmError(
+            f"0x{value:X} can't be encoded as a modified immediate"
+        ) from None
+
+
+def _t32(hw1, hw2):
+    return [hw1 & 0xFF, hw1 >> 8, hw2 & 0xFF, hw2 >> 8]
+
+
+def _t16(hw):
+    return [hw & 0xFF, hw >> 8]
+
+
+def _data_processing_imm(op, rn, rd, imm12, s=0):
+    """T32 "data processing (modified immediate)" encoding."""
+    i = (imm12 >> 11) & 1
+    imm3 = (imm12 >> 8) & 0x7
+    imm8 = imm12 & 0xFF
+    hw1 = 0xF000 | (i << 10) | (op << 5) | (s << 4) | rn
+    hw2 = (imm3 << 12) | (rd << 8) | imm8
+    return _t32(hw1, hw2)
+
+
+def _it(suffix, cond):
+    if cond not in CONDITIONS or len(suffix) > 3:
+        raise UnsupportedAsmError(f'Unsupported IT block "it{suffix} {cond}"')
+    firstcond = CONDITIONS[cond]
+    conds = [cond]
+    mask = 0
+    for n, x in enumerate(suffix):
+        if x == "t":
+            bit = firstcond & 1
+            conds.append(cond)
+        elif x == "e":
+            bit = (firstcond & 1) ^ 1
+            conds.append(_invert_condition(cond))
+        else:
+            raise UnsupportedAsmError(f'Unsupported IT block "it{suffix} {cond}"')
+        mask |= bit << (3 - n)
+    mask |= 1 << (3 - len(suffix))
+    return _t16(0xBF00 | (firstcond << 4) | mask), conds
+
+
+def _invert_condition(cond):
+    inverted = CONDITIONS[cond] ^ 1
+    for name, value in CONDITIONS.items():
+        if value == inverted:
+            return name
+
+
+def _assemble_one(mnemonic, width, operands, addr):
+    if mnemonic == "nop" and not operands:
+        return _t16(0xBF00) if width != "w" else _t32(0xF3AF, 0x8000)
+
+    if mnemonic == "mov" and width is None and len(operands) == 2:
+        if operands[1].startswith("#"):
+            raise UnsupportedAsmError("16-bit mov immediate")
+        rd = _register(operands[0], allow_sp=True)
+        rm = _register(operands[1], allow_sp=True)
+        return _t16(0x4600 | ((rd >> 3) << 7) | (rm << 3) | (rd & 0x7))
+
+    if mnemonic == "movw" and width is None and len(operands) == 2:
+        rd = _register(operands[0])
+        imm16 = _immediate(operands[1])
+        if not 0 <= imm16 <= 0xFFFF:
+            raise UnsupportedAsmError(f"movw immediate {imm16} out of range")
+        hw1 = 0xF240 | (((imm16 >> 11) & 1) << 10) | (imm16 >> 12)
+        hw2 = (((imm16 >> 8) & 0x7) << 12) | (rd << 8) | (imm16 & 0xFF)
+        return _t32(hw1, hw2)
+
+    if mnemonic == "mov" and width == "w" and len(operands) == 2:
+        rd = _register(operands[0])
+        if not operands[1].startswith("#"):
+            raise UnsupportedAsmError("mov.w register")
+        imm12 = _modified_immediate(_immediate(operands[1]))
+        return _data_processing_imm(0b0010, 0xF, rd, imm12)
+
+    if mnemonic == "cmp" and width == "w" and len(operands) == 2:
+        rn = _register(operands[0])
+        imm12 = _modified_immediate(_immediate(operands[1]))
+        return _data_processing_imm(0b1101, rn, 0xF, imm12, s=1)
+
+    if mnemonic in ("add", "sub") and width is None and len(operands) == 2:
+        # add/sub sp, #imm
+        if _register(operands[0], allow_sp=True) != SP:
+            raise UnsupportedAsmError(f"16-bit {mnemonic}")
+        imm = _immediate(operands[1])
+        if imm % 4 or not 0 <= imm <= 508:
+            raise UnsupportedAsmError(f"{mnemonic} sp immediate {imm} out of range")
+        return _t16((0xB080 if mnemonic == "sub" else 0xB000) | (imm >> 2))
+
+    if mnemonic in ("add", "sub") and width == "w" and len(operands) == 3:
+        rd = _register(operands[0])
+        rn = _register(operands[1], allow_sp=True)
+        imm12 = _modified_immediate(_immediate(operands[2]))
+        op = 0b1000 if mnemonic == "add" else 0b1101
+        return _data_processing_imm(op, rn, rd, imm12)
+
+    if mnemonic == "b" and len(operands) == 1:
+        offset = _immediate(operands[0]) - (addr + 4)
+        if offset % 2:
+            raise UnsupportedAsmError("Unaligned branch target")
+        if width is None:
+            if not -2048 <= offset <= 2046:
+                raise UnsupportedAsmError(f"b offset {offset} out of range")
+            return _t16(0xE000 | ((offset >> 1) & 0x7FF))
+        if not -(1 << 24) <= offset <= (1 << 24) - 2:
+            raise UnsupportedAsmError(f"b.w offset {offset} out of range")
+        offset &= 0x1FF_FFFF
+        s = offset >> 24
+        i1 = (offset >> 23) & 1
+        i2 = (offset >> 22) & 1
+        j1 = (i1 ^ 1) ^ s
+        j2 = (i2 ^ 1) ^ s
+        hw1 = 0xF000 | (s << 10) | ((offset >> 12) & 0x3FF)
+        hw2 = 0x9000 | (j1 << 13) | (j2 << 11) | ((offset >> 1) & 0x7FF)
+        return _t32(hw1, hw2)
+
+    raise UnsupportedAsmError(f'Unsupported instruction "{mnemonic}"')
+
+
+def assemble(string, addr=0):
+    """Assemble ``string`` as if it were located at ``addr``.
+
+    Same semantics as ``keystone.Ks(KS_ARCH_ARM, KS_MODE_THUMB).asm(string, addr)[0]``.
+
+    Returns
+    -------
+    list
+        Encoded instruction bytes.
+    """
+    encoding = []
+    it_conds = []
+
+    for instruction in re.split(r"[;\n]", string.strip().lower()):
+        instruction = instruction.strip()
+        if not instruction:
+            continue
+        mnemonic, _, operands = instruction.partition(" ")
+        operands = [x.strip() for x in operands.split(",")] if operands.strip() else []
+
+        mnemonic, _, width = mnemonic.partition(".")
+        if width not in ("", "w", "n"):
+            raise UnsupportedAsmError(f'Unknown width qualifier ".{width}"')
+        width = width or None
+
+        if mnemonic.startswith("it") and set(mnemonic[2:]) <= {"t", "e"}:
+            if it_conds or width or len(operands) != 1:
+                raise UnsupportedAsmError(f'Unsupported IT block "{instruction}"')
+            data, it_conds = _it(mnemonic[2:], operands[0])
+        else:
+            match = _MNEMONIC_RE.match(mnemonic)
+            if not match or match.group(1) not in _BASE_MNEMONICS:
+                raise UnsupportedAsmError(f'Unsupported instruction "{mnemonic}"')
+            base, cond = match.groups()
+
+            if it_conds:
+                expected = it_conds.pop(0)
+                if cond is None or CONDITIONS[cond] != CONDITIONS[expected]:
+                    raise UnsupportedAsmError(
+                        f'"{instruction}" does not match IT condition "{expected}"'
+                    )
+                if base == "b":
+                    raise UnsupportedAsmError("Branch in IT block")
+            elif cond is not None:
+                raise UnsupportedAsmError(f'Conditional "{instruction}" outside IT')
+
+            if width == "n":
+                raise UnsupportedAsmError("Explicit .n qualifier")
+            data = _assemble_one(base, width, operands, addr + len(encoding))
+
+        encoding.extend(data)
+
+    if it_conds:
+        raise UnsupportedAsmError("Incomplete IT block")
+    if not encoding:
+        raise UnsupportedAsmError("Empty assembly string")
+
+    return encoding
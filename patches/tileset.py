@@ -1,5 +1,8 @@
+import struct
+from functools import lru_cache
 from io import BytesIO
 from math import ceil
+from typing import NamedTuple
 
 import numpy as np
 from PIL import Image
@@ -7,7 +10,6 @@ from PIL import Image
 from .exception import ParsingError
 
 _BLOCK_SIZE = 16
-_BLOCK_PIXEL = _BLOCK_SIZE * _BLOCK_SIZE
 
 PALETTE_OFFSETS = [
     0xB_EC68,
@@ -16,67 +18,211 @@ PALETTE_OFFSETS = [
     0xB_F028,
     0xB_F168,
 ]
+PALETTE_NAMES = ["day", "night", "underwater", "unknown", "dawn"]
 
 
-def bytes_to_tilemap(data, palette=None, bpp=8, width=256):
+# Colors per chunk of the nearest palette color search
+_SEARCH_CHUNK = 4096
+
+
+def _palette_to_rgb(palette):
+    """(80, 3) RGB array of a 320 byte BGRA palette."""
+    p = np.frombuffer(palette, dtype=np.uint8).reshape((80, 4))
+    p = p[:, :3]
+    return np.fliplr(p)  # BGR->RGB
+
+
+class _PaletteMapper:
+    """Nearest palette index of 24-bit colors.
+
+    The search is exact (signed squared distance), runs in bounded chunks,
+    and only over colors that weren't seen before; the results are kept as
+    a sorted color -> index table.
+    """
+
+    def __init__(self, palette):
+        self.rgb = _palette_to_rgb(palette).astype(np.int32)
+        self._colors = np.empty(0, dtype=np.uint32)
+        self._indices = np.empty(0, dtype=np.uint8)
+
+    def _nearest(self, colors):
+        rgb = np.stack(
+            [(colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF], axis=-1
+        ).astype(np.int32)
+        out = np.empty(len(colors), dtype=np.uint8)
+        for i in range(0, len(colors), _SEARCH_CHUNK):
+            diff = rgb[i : i + _SEARCH_CHUNK, None, :] - self.rgb[None]
+            out[i : i + _SEARCH_CHUNK] = np.argmin((diff * diff).sum(axis=-1), axis=1)
+        return out
+
+    def __call__(self, rgb):
+        rgb = rgb.astype(np.uint32)
+        packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        colors, inverse = np.unique(packed, return_inverse=True)
+
+        pos = np.searchsorted(self._colors, colors)
+        known = pos < len(self._colors)
+        known[known] = self._colors[pos[known]] == colors[known]
+
+        if not known.all():
+            new_colors = colors[~known]
+            self._colors = np.concatenate([self._colors, new_colors])
+            self._indices = np.concatenate([self._indices, self._nearest(new_colors)])
+            order = np.argsort(self._colors)
+            self._colors, self._indices = self._colors[order], self._indices[order]
+            pos = np.searchsorted(self._colors, colors)
+
+        return self._indices[pos][inverse].reshape(packed.shape)
+
+
+@lru_cache(maxsize=16)
+def _palette_mapper(palette):
+    return _PaletteMapper(palette)
+
+
+def unpack_pixels(data, bpp):
+    """Split packed ``bpp`` bit pixels (MSB first) into one byte per pixel.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``uint8`` array of ``len(data) * 8 // bpp`` pixels.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    if bpp == 8:
+        return data
+    if bpp not in (1, 2, 4):
+        raise ValueError(f"Unsupported bpp {bpp}")
+    shifts = np.arange(8 - bpp, -1, -bpp, dtype=np.uint8)
+    return ((data[:, None] >> shifts) & ((1 << bpp) - 1)).ravel()
+
+
+def pack_pixels(pixels, bpp):
+    """Inverse of ``unpack_pixels``; only the low ``bpp`` bits of each pixel are kept.
+
+    Returns
+    -------
+    bytes
+    """
+    pixels = np.asarray(pixels, dtype=np.uint8).ravel()
+    if bpp == 8:
+        return pixels.tobytes()
+    if bpp not in (1, 2, 4):
+        raise ValueError(f"Unsupported bpp {bpp}")
+    per_byte = 8 // bpp
+    if len(pixels) % per_byte:
+        raise ValueError(f"{len(pixels)} pixels can't be packed at {bpp} bpp")
+    shifts = np.arange(8 - bpp, -1, -bpp, dtype=np.uint8)
+    pixels = (pixels.reshape(-1, per_byte) & ((1 << bpp) - 1)) << shifts
+    return np.bitwise_or.reduce(pixels, axis=1).astype(np.uint8).tobytes()
+
+
+def _tiles_to_canvas(data, width):
+    """Arrange consecutive 16x16 tiles row-major into a ``width`` wide canvas.
+
+    A partial last row (or tile) is padded with zeros.
+    """
+    if width % _BLOCK_SIZE:
+        raise ValueError(f"Width {width} isn't a multiple of {_BLOCK_SIZE}")
+    data = np.frombuffer(data, dtype=np.uint8)
+    n_rows = ceil(len(data) / (width * _BLOCK_SIZE))
+    tiles = np.zeros(n_rows * width * _BLOCK_SIZE, dtype=np.uint8)
+    tiles[: len(data)] = data
+    tiles = tiles.reshape(n_rows, width // _BLOCK_SIZE, _BLOCK_SIZE, _BLOCK_SIZE)
+    return tiles.transpose(0, 2, 1, 3).reshape(n_rows * _BLOCK_SIZE, width)
+
+
+def _canvas_to_tiles(canvas):
+    """Inverse of ``_tiles_to_canvas``.
+
+    Returns
+    -------
+    numpy.ndarray
+        Flat ``uint8`` array in tile order.
+    """
+    h, w = canvas.shape
+    if h % _BLOCK_SIZE or w % _BLOCK_SIZE:
+        raise ValueError(f"Shape {canvas.shape} isn't a multiple of {_BLOCK_SIZE}")
+    tiles = canvas.reshape(
+        h // _BLOCK_SIZE, _BLOCK_SIZE, w // _BLOCK_SIZE, _BLOCK_SIZE
+    ).transpose(0, 2, 1, 3)
+    return np.ascontiguousarray(tiles, dtype=np.uint8).ravel()
+
+
+def bytes_to_canvas(data, bpp=8, width=256):
+    """Assemble tile bytes into an index-image.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``(H, width)`` palette indices.
+    """
+    return _tiles_to_canvas(unpack_pixels(data, bpp), width)
+
+
+def canvas_to_tilemap(canvas, palette=None):
     """
     Parameters
     ----------
+    canvas : numpy.ndarray
+        Index-image from ``bytes_to_canvas``.
     palette : bytes
        320 long RGBA (80 colors). Alpha is ignored.
 
     Returns
     -------
     PIL.Image
-        Rendered RGB image.
+        Palettized image, or the raw indices if no palette is given.
     """
-
-    # assert bpp in [4, 8]
-
-    if bpp < 8:
-        nibbles = bytearray()
-        # offset = 0x0
-        for b in data:
-            shift = 8 - bpp
-            while shift >= 0:
-                nibbles.append(b >> shift & (2**bpp - 1))
-                shift -= bpp
-            # nibbles.append((b >> 4) | (offset << 4))
-            # nibbles.append((b & 0xF) | (offset << 4))
-        data = bytes(nibbles)
-        del nibbles
-
-    # Assemble bytes into an index-image
-    h, w = int(ceil(len(data) / width / _BLOCK_SIZE) * _BLOCK_SIZE), width
-    canvas = np.zeros((h, w), dtype=np.uint8)
-    i_sprite = 0
-    for i in range(0, len(data), _BLOCK_PIXEL):
-        sprite = data[i : i + _BLOCK_PIXEL]
-
-        x = i_sprite * _BLOCK_SIZE % w
-        y = _BLOCK_SIZE * (i_sprite * _BLOCK_SIZE // w)
-        view = canvas[y : y + _BLOCK_SIZE, x : x + _BLOCK_SIZE]
-        sprite_block = np.frombuffer(sprite, dtype=np.uint8).reshape(
-            _BLOCK_SIZE, _BLOCK_SIZE
-        )
-        view[:] = sprite_block
-
-        i_sprite += 1
-
     if palette is None:
         return Image.fromarray(canvas, "L")
 
     # Apply palette to index-image
-    p = np.frombuffer(palette, dtype=np.uint8).reshape((80, 4))
-    p = p[:, :3]
-    p = np.fliplr(p)  # BGR->RGB
-
     im = Image.fromarray(canvas, "P")
-    im.putpalette(p)
+    im.putpalette(_palette_to_rgb(palette))
 
     return im
 
 
+def bytes_to_tilemap(data, palette=None, bpp=8, width=256):
+    """
+    Parameters
+    ----------
+    palette : bytes
+       320 long RGBA (80 colors). Alpha is ignored.
+
+    Returns
+    -------
+    PIL.Image
+        Rendered RGB image.
+    """
+    return canvas_to_tilemap(bytes_to_canvas(data, bpp, width), palette)
+
+
+def render_palettes(canvas, palettes):
+    """Render the same index-image with several palettes at once.
+
+    All palettes are applied with a single gather.
+
+    Parameters
+    ----------
+    canvas : numpy.ndarray
+        Index-image from ``bytes_to_canvas``.
+    palettes : list
+        320 long RGBA palettes (80 colors). Alpha is ignored.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``(len(palettes), H, W, 3)`` RGB images.
+    """
+    # Like ``putpalette``, indices past the 80 colors are black.
+    rgb = np.zeros((len(palettes), 256, 3), dtype=np.uint8)
+    for i, palette in enumerate(palettes):
+        rgb[i, :80] = _palette_to_rgb(palette)
+    return rgb[:, canvas]
+
+
 def rgb_to_index(tilemap, palette):
     if isinstance(tilemap, Image.Image):
         tilemap = tilemap.convert("RGB")
@@ -86,18 +232,8 @@ def rgb_to_index(tilemap, palette):
     else:
         raise TypeError(f"Don't know how to handle tilemap type {type(tilemap)}")
 
-    # Convert rgb tilemap to index image
-    p = np.frombuffer(palette, dtype=np.uint8).reshape((80, 4))
-    p = p[:, :3]
-    p = np.fliplr(p)  # BGR->RGB
-    p = p[None, None].transpose(0, 1, 3, 2)  # (1, 1, 3, 80)
-
-    # Find closest color
-    diff = tilemap[..., None] - p
-    dist = np.linalg.norm(diff, axis=2)
-    tilemap = np.argmin(dist, axis=-1).astype(np.uint8)
-
-    return tilemap
+    # Find closest color; cached per palette.
+    return _palette_mapper(bytes(palette))(tilemap)
 
 
 def tilemap_to_bytes(tilemap, palette=None, bpp=8):
@@ -127,25 +263,120 @@ def tilemap_to_bytes(tilemap, palette=None, bpp=8):
         tilemap = rgb_to_index(tilemap, palette)
 
     # Need to undo the tiling now.
-    out = []
-    for i in range(0, tilemap.shape[0], _BLOCK_SIZE):
-        for j in range(0, tilemap.shape[1], _BLOCK_SIZE):
-            sprite = tilemap[i : i + _BLOCK_SIZE, j : j + _BLOCK_SIZE]
-            sprite_bytes = sprite.tobytes()
-            out.append(sprite_bytes)
-    out = b"".join(out)
-
-    if bpp == 4:
-        out_packed = bytearray()
-        assert len(out) % 2 == 0
-        for i in range(0, len(out), 2):
-            b1, b2 = out[i], out[i + 1]
-            b1 &= 0xF
-            b2 &= 0xF
-            out_packed.append((b1 << 4) | b2)
-        out = bytes(out_packed)
+    return pack_pixels(_canvas_to_tiles(tilemap), bpp)
+
+
+class Backdrop(NamedTuple):
+    """Parsed, not yet decompressed, easter egg image.
+
+    Layout::
+
+        0x0   u16  width
+        0x2   u16  height
+        0x4   u8   palette size
+        0x5   u8   padding
+        0x6   u16  RGB565 colors[palette size]
+        ...   u8   LZW minimum code size
+        ...        GIF image data sub-blocks, terminated by an empty block
+        ...   u8   0x3B trailer
+    """
+
+    width: int
+    height: int
+    palette: np.ndarray  # RGB565 colors
+    min_code_size: int
+    lzw: memoryview  # Sub-blocks including their length bytes and terminator
+    size: int  # Number of bytes consumed
+
+
+_BACKDROP_HEADER = struct.Struct("<HHBx")
+
+
+def _skip_sub_blocks(data, idx):
+    """Offset after the terminating empty sub-block starting at ``idx``."""
+    while True:
+        block_size = data[idx]
+        idx += 1 + block_size
+        if block_size == 0:
+            return idx
+
+
+def _parse_backdrop_header(data):
+    width, height, palette_size = _BACKDROP_HEADER.unpack_from(data)
+    lzw_start = _BACKDROP_HEADER.size + 2 * palette_size
+    return width, height, palette_size, lzw_start
+
+
+def backdrop_size(data):
+    """Number of bytes of the backdrop at the start of ``data``; nothing is decoded."""
+    data = memoryview(data)
+    *_, lzw_start = _parse_backdrop_header(data)
+    idx = _skip_sub_blocks(data, lzw_start + 1)
+    if data[idx] != 0x3B:
+        raise ParsingError("Invalid GIF Trailer")
+    return idx + 1
+
+
+def parse_backdrop(data):
+    """Parse the backdrop at the start of ``data`` without copying it.
+
+    Returns
+    -------
+    Backdrop
+    """
+    data = memoryview(data)
+    width, height, palette_size, lzw_start = _parse_backdrop_header(data)
+    palette = np.frombuffer(
+        data, dtype="<u2", count=palette_size, offset=_BACKDROP_HEADER.size
+    )
+    idx = _skip_sub_blocks(data, lzw_start + 1)
+    if data[idx] != 0x3B:
+        raise ParsingError("Invalid GIF Trailer")
+    return Backdrop(
+        width, height, palette, data[lzw_start], data[lzw_start + 1 : idx], idx + 1
+    )
 
-    return out
+
+def _rgb565_to_rgb888(pix):
+    pix = pix.astype(np.uint32)
+    r = ((pix >> 11) * 255 + 15) // 31
+    g = (((pix >> 5) & 0x3F) * 255 + 31) // 63
+    b = ((pix & 0x1F) * 255 + 15) // 31
+    return np.stack([r, g, b], axis=-1).astype(np.uint8)
+
+
+def backdrop_to_gif(backdrop):
+    """Wrap a parsed backdrop into a GIF89a file.
+
+    Returns
+    -------
+    bytes
+    """
+    palette_size = len(backdrop.palette)
+    gct_len = max(2, 1 << (palette_size - 1).bit_length())
+    gct = np.zeros((gct_len, 3), dtype=np.uint8)
+    gct[:palette_size] = _rgb565_to_rgb888(backdrop.palette)
+
+    return b"".join(
+        [
+            # Header and logical screen descriptor
+            struct.pack(
+                "<6sHHBBB",
+                b"GIF89a",
+                backdrop.width,
+                backdrop.height,
+                0x80 | (gct_len.bit_length() - 2),
+                0,
+                0,
+            ),
+            gct.tobytes(),
+            # Image descriptor
+            struct.pack("<BHHHHB", 0x2C, 0, 0, backdrop.width, backdrop.height, 0),
+            bytes([backdrop.min_code_size]),
+            backdrop.lzw,
+            b"\x3b",
+        ]
+    )
 
 
 def decode_backdrop(data):
@@ -161,89 +392,120 @@ def decode_backdrop(data):
     int
         Number of bytes consumed to create image.
     """
+    backdrop = parse_backdrop(data)
+    im = Image.open(BytesIO(backdrop_to_gif(backdrop)))
+    im.load()
+    return im, backdrop.size
+
+
+def decode_backdrops(data, starts):
+    """Decode several backdrops of ``data`` in a thread pool.
+
+    Returns
+    -------
+    list
+        ``PIL.Image.Image`` per offset in ``starts``.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    data = memoryview(data)
+    with ThreadPoolExecutor() as executor:
+        return list(executor.map(lambda x: decode_backdrop(data[x:])[0], starts))
+
+
+def lzw_encode(pixels, min_code_size):
+    """GIF LZW compression with a 4096 entry code table.
+
+    A clear code is emitted when the table is full, like the stock images.
 
-    def rgb565_to_rgba32(pix):
-        r = int(((pix >> 11) * 255 + 15) / 31)
-        g = int((((pix >> 5) & 0x3F) * 255 + 31) / 63)
-        b = int(((pix & 0x1F) * 255 + 15) / 31)
-        return r, g, b
-
-    idx = 0
-    out = []
-
-    # Header
-    out.append(b"GIF89a")
-
-    width = int.from_bytes(data[idx : idx + 2], "little")
-    idx += 2
-
-    height = int.from_bytes(data[idx : idx + 2], "little")
-    idx += 2
-
-    palette_size = data[idx]
-    idx += 1
-    idx += 1  # padding
-
-    palette = []
-    for _ in range(palette_size):
-        palette.append(int.from_bytes(data[idx : idx + 2], "little"))
-        idx += 2
-
-    gct_size = 0
-    calc_gct_size = 2
-    while calc_gct_size < palette_size:
-        gct_size += 1
-        calc_gct_size <<= 1
-
-    # Logical screen descriptor
-    out.append(width.to_bytes(2, "little"))
-    out.append(height.to_bytes(2, "little"))
-    out.append(((1 << 7) | gct_size).to_bytes(1, "little"))
-    out.append(b"\x00")
-    out.append(b"\x00")
-
-    # Global Color Table
-    for i in range(calc_gct_size):
-        if i < len(palette):
-            r, g, b = rgb565_to_rgba32(palette[i])
-            out.append(r.to_bytes(1, "little"))
-            out.append(g.to_bytes(1, "little"))
-            out.append(b.to_bytes(1, "little"))
+    Parameters
+    ----------
+    pixels : list
+        Palette indices.
+
+    Returns
+    -------
+    bytes
+        Code stream, not yet split into sub-blocks.
+    """
+    clear = 1 << min_code_size
+    eoi = clear + 1
+    out = bytearray()
+    acc = n_bits = 0
+    code_size = min_code_size + 1
+    next_code = eoi + 1
+    table = {}
+
+    def emit(code):
+        nonlocal acc, n_bits
+        acc |= code << n_bits
+        n_bits += code_size
+        while n_bits >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            n_bits -= 8
+
+    emit(clear)
+    pixels = iter(pixels)
+    prefix = next(pixels)
+    for pixel in pixels:
+        key = (prefix << 8) | pixel
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix)
+        # The decoder adds its entries (and grows the code size) one code later.
+        if next_code == (1 << code_size) and code_size < 12:
+            code_size += 1
+        if next_code < 4096:
+            table[key] = next_code
+            next_code += 1
         else:
-            out.append(b"\x00")
-            out.append(b"\x00")
-            out.append(b"\x00")
-
-    # Image descriptor
-    out.append(b"\x2c")
-    out.append(b"\x00\x00")  # x
-    out.append(b"\x00\x00")  # y
-    out.append(width.to_bytes(2, "little"))
-    out.append(height.to_bytes(2, "little"))
-    out.append(b"\x00")
-
-    # Frame
-    min_code_size = data[idx]
-    idx += 1
-    out.append(min_code_size.to_bytes(1, "little"))
+            emit(clear)
+            table.clear()
+            next_code = eoi + 1
+            code_size = min_code_size + 1
+        prefix = pixel
+    emit(prefix)
+    emit(eoi)
+    if n_bits:
+        out.append(acc & 0xFF)
+    return bytes(out)
 
-    while True:
-        block_size = data[idx]
-        idx += 1
-        out.append(block_size.to_bytes(1, "little"))
-        if block_size == 0:
-            break
-        out.append(data[idx : idx + block_size])
-        idx += block_size
 
-    trailer = data[idx]
-    idx += 1
+def _to_sub_blocks(data):
+    blocks = [
+        bytes([len(data[i : i + 255])]) + data[i : i + 255]
+        for i in range(0, len(data), 255)
+    ]
+    return b"".join(blocks) + b"\x00"
 
-    if trailer != 0x3B:
-        raise ParsingError("Invalid GIF Trailer")
-    out.append(trailer.to_bytes(1, "little"))
-    out = b"".join(out)
 
-    im = Image.open(BytesIO(out))
+def recompress_backdrop(data):
+    """Re-encode the LZW stream of the backdrop at the start of ``data``.
 
-    return im, idx
+    The header, palette and minimum code size are kept byte for byte and the
+    code table is only cleared when full, so the result only differs from the
+    stock image in how the pixels are split into LZW codes.
+
+    Returns
+    -------
+    bytes
+        The smaller of the re-encoded and the original backdrop.
+    """
+    backdrop = parse_backdrop(data)
+    original = bytes(memoryview(data)[: backdrop.size])
+    indices = np.array(Image.open(BytesIO(backdrop_to_gif(backdrop))))
+
+    *_, lzw_start = _parse_backdrop_header(original)
+    lzw = lzw_encode(indices.ravel().tolist(), backdrop.min_code_size)
+    out = original[: lzw_start + 1] + _to_sub_blocks(lzw) + b"\x3b"
+    if len(out) >= len(original):
+        return original
+
+    # Never trust the encoder with the only copy of the image.
+    check, size = decode_backdrop(out)
+    if size != len(out) or not np.array_equal(np.array(check), indices):
+        raise ParsingError("Re-encoded backdrop doesn't match the original")
+    return out
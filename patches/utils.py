@@ -35,95 +35,50 @@ def seconds_to_frames(seconds):
     return int(round(60 * seconds))
 
 
-def fds_crc(data, checksum=0x8000):
-    """
-    Do not include any existing checksum, not even the blank checksums 00 00 or FF FF.
-    The formula will automatically count 2 0x00 bytes without the programmer adding them manually.
-    Also, do not include the gap terminator (0x80) in the data.
-    If you wish to do so, change sum to 0x0000.
-    """
-    size = len(data)
-    for i in range(size + 2):
-        if i < size:
-            byte = data[i]
-        else:
-            byte = 0x00
-
-        for bit_index in range(8):
-            bit = (byte >> bit_index) & 0x1
+def _fds_crc_table():
+    """Register after 8 bit-steps of ``fds_crc`` starting from the low byte,
+    with zero data bits."""
+    table = []
+    for checksum in range(256):
+        for _ in range(8):
             carry = checksum & 0x1
-            checksum = (checksum >> 1) | (bit << 15)
+            checksum >>= 1
             if carry:
                 checksum ^= 0x8408
-    return checksum.to_bytes(2, "little")
-
-
-def fds_remove_crc_gaps(rom):
-    """Remove each block's CRC padding so it can be played by FDS
-    https://wiki.nesdev.org/w/index.php/FDS_disk_format
-    """
-    offset = 0x0
-
-    def get_block(size, crc_gap=2):
-        nonlocal offset
-        block = rom[offset : offset + size]
-        offset += size + crc_gap
-
-        return block
-
-    disk_info_block = get_block(0x38)
-
-    file_amount_block = get_block(0x2)
-    assert file_amount_block[0] == 0x02
-    n_files = file_amount_block[1]
+        table.append(checksum)
+    return table
 
-    blocks = [disk_info_block, file_amount_block]
-    for i in range(n_files):
-        file_header_block = get_block(0x10)
-        assert file_header_block[0] == 3
-        blocks.append(file_header_block)
 
-        file_size = int.from_bytes(file_header_block[13 : 13 + 2], "little")
-        file_data_block = get_block(file_size + 1)
-        blocks.append(file_data_block)
+_FDS_CRC_TABLE = _fds_crc_table()
 
-    out = b"".join(blocks)
 
-    # Zero pad to be 65500 bytes long
-    padding = b"\x00" * (65500 - len(out))
-    out += padding
+def _fds_crc_int(data, checksum):
+    table = _FDS_CRC_TABLE
+    # Data bits are shifted in at the top, so they can't affect the feedback
+    # of the byte they are shifted in with.
+    for byte in data:
+        checksum = (checksum >> 8) ^ (byte << 8) ^ table[checksum & 0xFF]
+    for _ in range(2):
+        checksum = (checksum >> 8) ^ table[checksum & 0xFF]
+    return checksum
 
-    return out
 
+def fds_crc(data, checksum=0x8000):
+    """
+    Do not include any existing checksum, not even the blank checksums 00 00 or FF FF.
+    The formula will automatically count 2 0x00 bytes without the programmer adding them manually.
+    Also, do not include the gap terminator (0x80) in the data.
+    If you wish to do so, change sum to 0x0000.
+    """
+    return _fds_crc_int(data, checksum).to_bytes(2, "little")
 
-def fds_add_crc_gaps(rom):
-    """Add CRC gaps"""
-    offset = 0x0
-
-    def get_block(size):
-        nonlocal offset
-        block = bytes(rom[offset : offset + size])
-        offset += size
-        crc = fds_crc(block)
-        return block + crc
-
-    disk_info_block = get_block(0x38)
-
-    file_amount_block = get_block(0x2)
-    assert file_amount_block[0] == 0x02
-    n_files = file_amount_block[1]
-
-    blocks = [disk_info_block, file_amount_block]
-
-    for i in range(n_files):
-        file_header_block = get_block(0x10)
-        assert file_header_block[0] == 3
-        blocks.append(file_header_block)
-
-        file_size = int.from_bytes(file_header_block[13 : 13 + 2], "little")
-        file_data_block = get_block(file_size + 1)
-        blocks.append(file_data_block)
 
-    out = b"".join(blocks)
+def fds_crcs(blocks, checksum=0x8000):
+    """``fds_crc`` of every block, e.g. all blocks of a disk side.
 
-    return out
+    Returns
+    -------
+    list
+        2-byte little endian CRC per block.
+    """
+    return [_fds_crc_int(block, checksum).to_bytes(2, "little") for block in blocks]
@@ -50,29 +50,45 @@ Start      End        Description
 0x3F0000   0x400000   Empty
 """
 
-
 from pathlib import Path
 
+from .devices import ZELDA
 from .exception import InvalidStockRomError
+from .fds import FdsDisk
 from .firmware import Device, ExtFirmware, Firmware, IntFirmware
-from .tileset import decode_backdrop
-from .utils import fds_remove_crc_gaps, printd, printi
+from .utils import printd, printi
 
 build_dir = Path("build")  # TODO: expose this properly or put in better location
 
+# (name, offset) of the 11 backdrop images
+BACKDROPS = [
+    ("0", 0x1F4C00),
+    ("1", 0x205A80),
+    ("2", 0x211920),
+    ("3", 0x213840),
+    ("4", 0x222500),
+    ("5", 0x234140),
+    ("6", 0x242480),
+    ("7", 0x253960),
+    ("8", 0x25CF20),
+    ("9", 0x26AB00),
+    ("10", 0x279FA0),
+]
+BACKDROPS_END = 0x288120
+
 
 class ZeldaGnW(Device, name="zelda"):
     class Int(IntFirmware):
-        STOCK_ROM_SHA1_HASH = "ac14bcea6e4ff68c88fd2302c021025a2fb47940"
-        STOCK_ROM_END = 0x1B3E0  # Used for generating linker script.
-        KEY_OFFSET = 0x165A4
-        NONCE_OFFSET = 0x16590
+        STOCK_ROM_SHA1_HASH = ZELDA.int_sha1
+        STOCK_ROM_END = ZELDA.stock_rom_end
+        KEY_OFFSET = ZELDA.key_offset
+        NONCE_OFFSET = ZELDA.nonce_offset
         RWDATA_OFFSET = 0x1B390
         RWDATA_LEN = 20
         RWDATA_DTCM_IDX = 0  # decompresses to 0x2000_A800
 
     class Ext(ExtFirmware):
-        STOCK_ROM_SHA1_HASH = "1c1c0ed66d07324e560dcd9e86a322ec5e4c1e96"
+        STOCK_ROM_SHA1_HASH = ZELDA.ext_sha1
         ENC_START = 0x20000
         ENC_END = 0x3254A0
 
@@ -82,10 +98,13 @@ class ZeldaGnW(Device, name="zelda"):
                 raise InvalidStockRomError
 
     class FreeMemory(Firmware):
-        FLASH_BASE = 0x240F2124
-        FLASH_LEN = 0  # 0x24100000 - FLASH_BASE
+        # Free RAM after the novel code's RAM region.
+        FLASH_BASE = ZELDA.ram_origin + ZELDA.ram_length
+        FLASH_LEN = 0x240F_CFF8 - FLASH_BASE
 
-    def argparse(self, parser):
+    @classmethod
+    def argparse(cls, parser):
+        """Add device-specific arguments, then parse and validate all arguments."""
         group = parser.add_argument_group("Low level flash savings flags")
         group.add_argument(
             "--no-la",
@@ -126,8 +145,8 @@ class ZeldaGnW(Device, name="zelda"):
             action="store_true",
             help="Remove the hour tune in TIME/CLOCK.",
         )
-        self.args = parser.parse_args()
-        return self.args
+        args = parser.parse_args()
+        return args
 
     def _flash_roms(self):
         # English Zelda 1
@@ -158,58 +177,50 @@ class ZeldaGnW(Device, name="zelda"):
             self.external[loz2_addr : loz2_addr + loz2_size] = loz2
 
     def _dump_roms(self):
+        ext = self.external
+
         # English Zelda 1
-        rom_addr = 0x3_0000
-        rom_size = 0x2_0000
-        (build_dir / "Legend of Zelda, The (USA).nes").write_bytes(
-            b"NES\x1a\x08\x00\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            + self.external[rom_addr : rom_addr + rom_size]
+        self.dump(
+            build_dir / "Legend of Zelda, The (USA).nes",
+            lambda: b"NES\x1a\x08\x00\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+            + ext[0x3_0000:0x5_0000],
+            group="roms",
         )
 
         # Japanse Zelda 1
         # This rom doesn't work :(
-        rom_addr = 0x5_0000
-        rom_size = 0x1_0000
-        rom1 = bytearray(self.external[rom_addr : rom_addr + rom_size])
         # bios = self.external[0x5_E000:0x6_0000]
-        rom1 = fds_remove_crc_gaps(rom1)
-        rom_addr = 0x6_0000
-        rom_size = 0x1_0000
-        rom2 = fds_remove_crc_gaps(self.external[rom_addr : rom_addr + rom_size])
-        (build_dir / "Zelda no Densetsu: The Hyrule Fantasy (J).fds").write_bytes(
-            rom1 + rom2
+        self.dump(
+            build_dir / "Zelda no Densetsu: The Hyrule Fantasy (J).fds",
+            lambda: FdsDisk.from_gapped(ext, [0x5_0000, 0x6_0000]).to_bytes(),
+            group="roms",
         )
 
         # English Zelda 2
-        rom_addr = 0x7_0000
-        rom_size = 0x4_0000
-        (build_dir / "Zelda II - Adventure of Link (USA).nes").write_bytes(
-            b"NES\x1a\x08\x10\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-            + self.external[rom_addr : rom_addr + rom_size]
+        self.dump(
+            build_dir / "Zelda II - Adventure of Link (USA).nes",
+            lambda: b"NES\x1a\x08\x10\x12\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+            + ext[0x7_0000:0xB_0000],
+            group="roms",
         )
 
         # Japanse Zelda 2
         # This rom doesn't work :(
-        rom_addr = 0xB_0000
-        rom_size = 0x1_0000
-        rom1 = bytearray(self.external[rom_addr : rom_addr + rom_size])
         # bios = self.external[0xB_E000:0xC_0000]
-        rom1 = fds_remove_crc_gaps(rom1)
-        rom_addr = 0xC_0000
-        rom_size = 0x1_0000
-        rom2 = fds_remove_crc_gaps(self.external[rom_addr : rom_addr + rom_size])
-        (build_dir / "Link no Bouken - The Legend of Zelda 2 (J).fds").write_bytes(
-            rom1 + rom2
+        self.dump(
+            build_dir / "Link no Bouken - The Legend of Zelda 2 (J).fds",
+            lambda: FdsDisk.from_gapped(ext, [0xB_0000, 0xC_0000]).to_bytes(),
+            group="roms",
         )
 
         # I Believe 0xD_0000 ~ 0xD_2000 are LoZ2-JP tweaks... or maybe just the timer?
 
         # English Link's Awakening
         # This rom doesn't work :(
-        rom_addr = 0xD_2000
-        rom_size = 0x8_0000
-        (build_dir / "Legend of Zelda, The - Link's Awakening (en).gb").write_bytes(
-            self.external[rom_addr : rom_addr + rom_size]
+        self.dump(
+            build_dir / "Legend of Zelda, The - Link's Awakening (en).gb",
+            lambda: ext[0xD_2000:0x15_2000],
+            group="roms",
         )
 
     def _erase_roms(self):
@@ -269,23 +280,13 @@ class ZeldaGnW(Device, name="zelda"):
         0x26AB00    0x279f98
         0x279FA0    0x28811d
         """
-        bytes_starts = [
-            ("0", 0x1F4C00),
-            ("1", 0x205A80),
-            ("2", 0x211920),
-            ("3", 0x213840),
-            ("4", 0x222500),
-            ("5", 0x234140),
-            ("6", 0x242480),
-            ("7", 0x253960),
-            ("8", 0x25CF20),
-            ("9", 0x26AB00),
-            ("10", 0x279FA0),
-        ]
-        for name, start in bytes_starts:
-            img, consumed = decode_backdrop(self.external[start:])
-            img.save(build_dir / f"backdrop_{name}.png")
-            # print(hex(start + consumed))
+        from .tileset import decode_backdrops
+
+        self.dump_many(
+            [build_dir / f"backdrop_{name}.png" for name, _ in BACKDROPS],
+            lambda: decode_backdrops(self.external, [x for _, x in BACKDROPS]),
+            group="graphics",
+        )
 
     def _disable_save_encryption(self):
         # Skip ingame save encryption
@@ -348,10 +349,6 @@ class ZeldaGnW(Device, name="zelda"):
             self.internal.replace(0x8, "NMI_Handler")
             self.internal.replace(0xC, "HardFault_Handler")
 
-        from .tileset import bytes_to_tilemap
-
-        _ = bytes_to_tilemap(self.external[0x20000:0x30000])
-
         self._disable_save_encryption()
 
         printi("Invoke custom bootloader prior to calling stock Reset_Handler.")
@@ -378,19 +375,22 @@ class ZeldaGnW(Device, name="zelda"):
         if False:
             # This doesn't quite work yet
             # I think RWData stuff probably needs to be updated
+            # Every reader of a pointer into 0xB0000-0xCE000 (DTCM rwdata and
+            # literal pools, not only the memcpy at 0xF702 via 0xFD1C) has to
+            # go through memcpy_inflate first; those readers aren't mapped yet.
             printd("Compressing and moving LoZ2 JP ROM data to int")
             compressed_len = self.external.compress(0xB_0000, 0x1E000)
             self.internal.asm(0xF702, b_w_memcpy_inflate_asm)
             self.move_to_int(0xB_0000, compressed_len, 0xFD1C)
 
-        printd("Compressing and moving LoZ2 TIMER data to int")
-        compressed_len = self.external.compress(0xD_0000, 0x2000)
-        self.internal.asm(0xF430, b_w_memcpy_inflate_asm)
-        self.move_to_int(0xD_0000, compressed_len, 0xFCF8)
+        # The only clock asset verified so far, and FreeMemory is sized to it.
+        # Only referenced by the memcpy at 0xF430, which works unmodified from RAM.
+        printd("Moving LoZ2 TIMER data to compressed_memory")
+        self.move_to_compressed_memory(0xD_0000, 0x2000, 0xFCF8)
 
         if self.args.no_la:
             printi("Removing Link's Awakening (All Languages)")
-            self.external.clear_range(0xD2000, 0x1F4C00)
+            self.free_ext(0xD2000, 0x1F4C00 - 0xD2000)
             self.external[0x315B54] = 0x00  # Ignore LA EN menu selection
             self.external[0x315B58] = 0x00  # Ignore LA FR menu selection
             self.external[0x315B5C] = 0x00  # Ignore LA DE menu selection
@@ -399,7 +399,7 @@ class ZeldaGnW(Device, name="zelda"):
             # removing to free up an island of space.
 
         if self.args.no_sleep_images:
-            self.external.clear_range(0x1F4C00, 0x288120)
+            self.free_ext(BACKDROPS[0][1], BACKDROPS_END - BACKDROPS[0][1])
 
             # setting this to NULL doesn't just display a black image, I
             # don't think the drawing code has a NULL check.
@@ -407,6 +407,27 @@ class ZeldaGnW(Device, name="zelda"):
 
             # TODO: make this work with moving stuff around, currently just
             # removing to free up an island of space.
+        elif not self.args.no_recompress_images:
+            printi("Recompressing backdrop images.")
+            start = BACKDROPS[0][1]
+            self.recompress_backdrops(BACKDROPS, BACKDROPS_END)
+            # The image table lives in the DTCM rwdata (see the rwdata_erase
+            # note above). recompress_backdrops already refused references
+            # into the middle of an image, so only image starts are updated.
+            self.rwdata_lookup(start, BACKDROPS_END - start)
+            self.literal_pool_lookup(
+                self.internal,
+                start,
+                BACKDROPS_END - start,
+                end=self.internal.STOCK_ROM_END,
+            )
+
+        if self.compressed_memory_pos:
+            # Compress and copy over compressed_memory
+            self.internal.rwdata.append(
+                self.compressed_memory[: self.compressed_memory_pos].copy(),
+                self.compressed_memory.FLASH_BASE,
+            )
 
         # Compress, insert, and reference the modified rwdata
         self.int_pos += self.internal.rwdata.write_table_and_data(
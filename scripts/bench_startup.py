@@ -0,0 +1,66 @@
+""" Benchmark cold-start latency of the patcher CLI.
+
+Usage:
+    python -m scripts.bench_startup [--runs N]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+HEAVY_MODULES = ["numpy", "PIL", "Crypto", "elftools", "keystone"]
+
+COMMANDS = {
+    "import patch": [sys.executable, "-c", "import patch"],
+    "patch.py --help": [sys.executable, "patch.py", "--help"],
+    "invalid --sleep-time": [sys.executable, "patch.py", "--sleep-time=0"],
+}
+
+
+def heavy_imports():
+    """Heavy modules that get imported by ``import patch``."""
+    code = (
+        "import sys, patch; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=REPO_ROOT,
+    )
+    return out.stdout.split()
+
+
+def bench(cmd, runs):
+    times = []
+    for _ in range(runs):
+        t_start = time.perf_counter()
+        subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=REPO_ROOT
+        )
+        times.append(time.perf_counter() - t_start)
+    return times
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, cmd in COMMANDS.items():
+        times = bench(cmd, args.runs)
+        print(
+            f"{name:<24} median {1000 * statistics.median(times):7.1f}ms  "
+            f"min {1000 * min(times):7.1f}ms"
+        )
+
+    heavy = heavy_imports()
+    print(f"Heavy modules imported by `import patch`: {heavy or 'none'}")
+    if heavy:
+        sys.exit(1)
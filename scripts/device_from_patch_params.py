@@ -1,13 +1,15 @@
 """ Dictates device used in Makefile and C parts of the code
+
+Only depends on ``patches.devices`` since this runs on every make invocation.
 """
 import argparse
 from pathlib import Path
 
-from patches import Device
+from patches.devices import DEVICES, linker_script
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--device", default="mario", choices=["mario", "zelda"])
+    parser.add_argument("--device", default="mario", choices=list(DEVICES))
     args, _ = parser.parse_known_args()
     device = args.device.upper()
     print(device)
@@ -20,23 +22,7 @@ if __name__ == "__main__":
     except FileNotFoundError:
         old_ld = ""
 
-    device = Device.registry[args.device]
-
-    new_ld = f"""
-__STOCK_ROM_END__ = 0x{device.Int.STOCK_ROM_END:08X};
-"""
-    if device.name == "mario":
-        new_ld += f"""
-__RAM_ORIGIN__ = 0x30010000;
-__RAM_LENGTH__ = {64 * (1 << 10) - 8192};
-"""
-    elif device.name == "zelda":
-        new_ld += """
-__RAM_ORIGIN__ = 0x240ec524;
-__RAM_LENGTH__ = 68308;
-"""
-    else:
-        raise ValueError(f"Unsupported device {device.name}")
+    new_ld = linker_script(DEVICES[args.device])
     if new_ld != old_ld:
         ld_path.parent.mkdir(exist_ok=True)
         ld_path.write_text(new_ld)
@@ -0,0 +1,52 @@
+import pytest
+
+from patches.allocator import RegionAllocator
+from patches.exception import NotEnoughSpaceError
+
+
+def test_free_coalesces():
+    alloc = RegionAllocator(0x1000)
+    assert alloc.high_water_mark == 0x1000
+    alloc.free(0x100, 0x100)
+    alloc.free(0x300, 0x100)
+    alloc.free(0x200, 0x100)
+    assert list(alloc) == [(0x100, 0x400)]
+    assert alloc.free_space == 0x300
+
+    with pytest.raises(ValueError):
+        alloc.free(0x3F0, 0x20)  # Double free
+
+
+def test_best_fit_and_alignment():
+    alloc = RegionAllocator(0x10000)
+    alloc.free(0x0, 0x800)
+    alloc.free(0x1002, 0x102)
+    alloc.free(0x2000, 0x200)
+
+    assert alloc.allocate(0x100) == 0x1004  # Smallest hole, aligned
+    assert alloc.allocate(0x100) == 0x2000
+    assert alloc.allocate(0x200) == 0x0
+    assert alloc.allocate(0x100, align=0x400) == 0x400
+    assert list(alloc) == [
+        (0x200, 0x400),
+        (0x500, 0x800),
+        (0x1002, 0x1004),
+        (0x2100, 0x2200),
+    ]
+
+    with pytest.raises(NotEnoughSpaceError):
+        alloc.allocate(0x400)
+
+
+def test_limit_and_high_water_mark():
+    alloc = RegionAllocator(0x4000)
+    alloc.free(0x3000, 0x1000)
+    alloc.free(0x1000, 0x100)
+    assert alloc.high_water_mark == 0x3000
+
+    alloc.free(0x2000, 0x1000)  # Merges with the trailing hole
+    # Every hole starts past the limit
+    with pytest.raises(NotEnoughSpaceError):
+        alloc.allocate(0x100, limit=0x800)
+    assert alloc.allocate(0x800, limit=0x2000) == 0x2000
+    assert alloc.high_water_mark == 0x2800
@@ -0,0 +1,37 @@
+import os
+
+import pytest
+from PIL import Image
+
+from patches.artifacts import GROUPS, ArtifactWriter, parse_groups
+
+
+def test_parse_groups():
+    assert parse_groups("roms, graphics") == {"roms", "graphics"}
+    assert parse_groups("all") == set(GROUPS)
+    assert parse_groups("none") == set()
+    with pytest.raises(ValueError):
+        parse_groups("roms,foo")
+
+
+def test_writer_skips_unchanged(tmp_path):
+    writer = ArtifactWriter(["debug"])
+    assert writer.wants("debug") and not writer.wants("roms")
+
+    data = bytearray(b"abc")
+    writer.submit(tmp_path / "a.bin", data)
+    data[:] = b"xyz"  # Snapshotted on submit
+    writer.submit(tmp_path / "sub" / "b.png", Image.new("RGB", (4, 4), (255, 0, 0)))
+    assert writer.close() == 2
+    assert (tmp_path / "a.bin").read_bytes() == b"abc"
+    assert Image.open(tmp_path / "sub" / "b.png").getpixel((0, 0)) == (255, 0, 0)
+
+    os.utime(tmp_path / "a.bin", (0, 0))
+    writer.submit(tmp_path / "a.bin", b"abc")
+    writer.submit(tmp_path / "sub" / "b.png", Image.new("RGB", (4, 4), (255, 0, 0)))
+    assert writer.close() == 0
+    assert (tmp_path / "a.bin").stat().st_mtime == 0
+
+    writer.submit(tmp_path / "a.bin", b"abd")
+    assert writer.close() == 1
+    assert (tmp_path / "a.bin").read_bytes() == b"abd"
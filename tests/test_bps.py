@@ -0,0 +1,116 @@
+import random
+import struct
+import zlib
+
+import pytest
+
+from patches.bps import (
+    SOURCE_COPY,
+    SOURCE_READ,
+    TARGET_COPY,
+    TARGET_READ,
+    apply,
+    parse_header,
+)
+from patches.exception import InvalidBPSError
+
+
+def _number(value):
+    out = bytearray()
+    while True:
+        x = value & 0x7F
+        value >>= 7
+        if value == 0:
+            out.append(0x80 | x)
+            return bytes(out)
+        out.append(x)
+        value -= 1
+
+
+def _action(command, length, payload=b""):
+    return _number(((length - 1) << 2) | command) + payload
+
+
+def _offset(delta):
+    return _number((abs(delta) << 1) | (delta < 0))
+
+
+def _make_patch(source, target, actions, metadata=b""):
+    body = (
+        b"BPS1"
+        + _number(len(source))
+        + _number(len(target))
+        + _number(len(metadata))
+        + metadata
+        + b"".join(actions)
+    )
+    body += struct.pack("<II", zlib.crc32(source), zlib.crc32(target))
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def _example():
+    rng = random.Random(0)
+    source = rng.randbytes(1000)
+    target = (
+        source[:100]  # SourceRead
+        + b"hello"  # TargetRead
+        + source[500:600]  # SourceCopy
+        + source[598:600] * 4  # TargetCopy (overlapping)
+        + source[213:300]  # SourceRead
+    )
+    actions = [
+        _action(SOURCE_READ, 100),
+        _action(TARGET_READ, 5, b"hello"),
+        _action(SOURCE_COPY, 100) + _offset(500),
+        _action(TARGET_COPY, 8) + _offset(203),
+        _action(SOURCE_READ, 87),
+    ]
+    return source, target, actions
+
+
+def test_number():
+    for value in (0, 1, 127, 128, 300, 16511, 16512, 1 << 30):
+        patch = b"BPS1" + _number(value) + _number(0) + _number(0) + bytes(12)
+        assert parse_header(patch).source_size == value
+
+
+def test_apply():
+    source, target, actions = _example()
+    patch = _make_patch(source, target, actions, metadata=b"<xml/>")
+
+    header = parse_header(patch)
+    assert (header.source_size, header.target_size) == (len(source), len(target))
+    assert header.metadata == b"<xml/>"
+    assert apply(source, patch) == target
+
+
+def test_crc():
+    source, target, actions = _example()
+    patch = bytearray(_make_patch(source, target, actions))
+
+    with pytest.raises(InvalidBPSError, match="different source"):
+        apply(source[:-1] + b"\x00", patch)
+
+    corrupt = bytearray(patch)
+    corrupt[20] ^= 0xFF
+    with pytest.raises(InvalidBPSError, match="Corrupt"):
+        apply(source, corrupt)
+
+    wrong_target = _make_patch(source, target[:-1] + b"\x00", actions)
+    with pytest.raises(InvalidBPSError, match="Target CRC"):
+        apply(source, wrong_target)
+
+
+def test_invalid():
+    with pytest.raises(InvalidBPSError):
+        parse_header(b"UPS1" + bytes(20))
+    with pytest.raises(InvalidBPSError):
+        parse_header(b"BPS1")
+
+    source, target, _ = _example()
+    with pytest.raises(InvalidBPSError, match="out of range"):
+        apply(
+            source, _make_patch(source, target, [_action(TARGET_COPY, 4) + _offset(0)])
+        )
+    with pytest.raises(InvalidBPSError, match="whole target"):
+        apply(source, _make_patch(source, target, [_action(SOURCE_READ, 10)]))
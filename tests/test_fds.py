@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+from patches.exception import ParsingError
+from patches.fds import (
+    DISK_INFO,
+    FILE_AMOUNT,
+    FILE_DATA,
+    FILE_HEADER,
+    GAPPED_SIDE_SIZE,
+    SIDE_SIZE,
+    FdsDisk,
+    FdsSide,
+)
+from patches.utils import fds_crc
+
+
+def _make_blocks(rng, file_sizes):
+    blocks = [bytes([DISK_INFO]) + rng.randbytes(0x37)]
+    blocks.append(bytes([FILE_AMOUNT, len(file_sizes)]))
+    for size in file_sizes:
+        header = bytearray(rng.randbytes(0x10))
+        header[0] = FILE_HEADER
+        header[13:15] = size.to_bytes(2, "little")
+        blocks.append(bytes(header))
+        blocks.append(bytes([FILE_DATA]) + rng.randbytes(size))
+    return blocks
+
+
+def _gapped(blocks, size=GAPPED_SIDE_SIZE):
+    out = b"".join(x + fds_crc(x) for x in blocks)
+    return out + b"\xFF" * (size - len(out))
+
+
+def _gapless(blocks):
+    out = b"".join(blocks)
+    return out + b"\x00" * (SIDE_SIZE - len(out))
+
+
+def test_side_index():
+    blocks = _make_blocks(random.Random(0), [0x100, 0, 0x2000])
+    side = FdsSide(_gapped(blocks))
+
+    assert [x.type for x in side.blocks] == [1, 2, 3, 4, 3, 4, 3, 4]
+    assert [bytes(side[i]) for i in range(len(side))] == blocks
+    assert side.size == sum(len(x) + 2 for x in blocks)
+    assert side.blocks[1].offset == 0x38 + 2
+
+
+def test_disk_round_trip():
+    rng = random.Random(1)
+    sides = [_make_blocks(rng, [0x300, 0x40]), _make_blocks(rng, [0x1000])]
+    image = b"".join(_gapped(x) for x in sides)
+
+    disk = FdsDisk.from_gapped(image, [0, GAPPED_SIDE_SIZE])
+    fds = disk.to_bytes()
+    assert fds == b"".join(_gapless(x) for x in sides)
+
+    gapped = FdsDisk.from_fds(fds).to_bytes(gapped=True)
+    assert gapped == b"".join(b"".join(y + fds_crc(y) for y in x) for x in sides)
+
+    header = b"FDS\x1a\x02" + bytes(11)
+    assert FdsDisk.from_fds(header + fds).to_bytes() == fds
+
+
+def test_from_gapped_is_zero_copy():
+    image = bytearray(_gapped(_make_blocks(random.Random(2), [0x10])))
+    disk = FdsDisk.from_gapped(image, [0])
+    image[0x38 + 2 + 2 + 2 + 1] = 0xAB
+    assert disk.sides[0][2][1] == 0xAB
+
+
+def test_invalid():
+    blocks = _make_blocks(random.Random(3), [0x10])
+    data = bytearray(_gapped(blocks))
+    data[0x38 + 2] = FILE_HEADER
+    with pytest.raises(ParsingError):
+        FdsSide(data)
+
+    big = _make_blocks(random.Random(4), [SIDE_SIZE])
+    with pytest.raises(ParsingError):
+        FdsSide(b"".join(big)[:-1], gapped=False)
+    with pytest.raises(ParsingError):
+        FdsDisk([FdsSide(b"".join(big), gapped=False)]).to_bytes()
@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+from patches.exception import InvalidIPSError
+from patches.ips import Record, apply, encode, iter_records, make_patch
+
+
+def test_iter_records():
+    patch = (
+        b"PATCH" + b"\x00\x00\x10\x00\x02AB" + b"\x00\x00\x20\x00\x00\x00\x05Z" + b"EOF"
+    )
+    records = list(iter_records(patch))
+    assert records == [
+        Record(0x10, 2, b"AB"),
+        Record(0x20, 5, b"Z", rle=True),
+    ]
+    assert encode(records) == patch
+
+    target = apply(bytearray(0x30), patch)
+    assert target[0x10:0x12] == b"AB"
+    assert target[0x20:0x25] == b"ZZZZZ"
+    assert target.count(0) == 0x30 - 7
+
+
+@pytest.mark.parametrize(
+    "patch",
+    [
+        b"",
+        b"PATC",
+        b"PATCH",
+        b"PATCH\x00\x00\x10\x00\x05AB",
+        b"PATCH\x00\x00\x10\x00\x00\x00",
+    ],
+)
+def test_invalid(patch):
+    with pytest.raises(InvalidIPSError):
+        list(iter_records(patch))
+
+
+def test_apply_shift():
+    patch = encode([Record(0, 20, b"\x01", rle=True), Record(40, 2, b"AB")])
+    target = apply(bytearray(32), patch, shift=-16)
+    assert target[:4] == b"\x01" * 4
+    assert target[24:26] == b"AB"
+
+    with pytest.raises(InvalidIPSError):
+        apply(bytearray(20), patch)
+
+
+def test_make_patch():
+    rng = random.Random(0)
+    old = rng.randbytes(0x2000)
+    new = bytearray(old)
+    new[0x100:0x180] = b"\x00" * 0x80
+    new[0x200:0x204] = b"abcd"
+    new[0x206:0x208] = b"ef"
+    new[0x1FFF] ^= 0xFF
+
+    patch = make_patch(old, new, offset=0x8000)
+    records = list(iter_records(patch))
+    assert [(x.offset, x.size, x.rle) for x in records] == [
+        (0x8100, 0x80, True),
+        (0x8200, 8, False),
+        (0x9FFF, 1, False),
+    ]
+
+    target = bytearray(0x8000) + bytearray(old)
+    assert apply(target, patch)[0x8000:] == new
+    assert make_patch(old, old) == b"PATCHEOF"
+    with pytest.raises(ValueError):
+        make_patch(old, old[:-1])
+
+
+def test_encode_large_records():
+    records = [
+        Record(0, 0x1_0001, b"\x07", rle=True),
+        Record(0x2_0000, 0x1_0000, bytes(0x1_0000)),
+    ]
+    records_out = list(iter_records(encode(records)))
+    assert [(x.offset, x.size) for x in records_out] == [
+        (0, 0xFFFF),
+        (0xFFFF, 2),
+        (0x2_0000, 0xFFFF),
+        (0x2_FFFF, 1),
+    ]
+    with pytest.raises(InvalidIPSError):
+        encode([Record(0x454F46, 1, b"\x00")])
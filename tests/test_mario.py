@@ -0,0 +1,57 @@
+import lzma
+import random
+
+from patches.ips import apply
+from patches.mario import (
+    SMB1_CHR_END,
+    SMB1_CHR_START,
+    SMB1_CHR_XOR_HEADER,
+    SMB1_SIZE,
+    _smb1_graphics_mod,
+)
+
+
+def _inflate(data):
+    """``memcpy_inflate``: raw LZMA with the props in ``LZMA_PROP_DATA``."""
+    filters = [{"id": lzma.FILTER_LZMA1, "dict_size": 16 * 1024}]
+    decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+    return decompressor.decompress(data)[: SMB1_CHR_END - SMB1_CHR_START]
+
+
+def _prepare_clock_rom(rom, mod):
+    working = bytearray(rom)
+    stock = rom[SMB1_CHR_START:SMB1_CHR_END]
+    if mod.startswith(SMB1_CHR_XOR_HEADER):
+        xor = _inflate(mod[len(SMB1_CHR_XOR_HEADER) :])
+        working[SMB1_CHR_START:SMB1_CHR_END] = bytes(a ^ b for a, b in zip(xor, stock))
+    elif mod.startswith(b"PATCH"):
+        apply(working, mod)
+    else:
+        working[SMB1_CHR_START:SMB1_CHR_END] = _inflate(mod)
+    return working
+
+
+def test_smb1_graphics_mod(tmp_path):
+    rng = random.Random(0)
+    rom = rng.randbytes(SMB1_SIZE)
+    path = tmp_path / "mod.nes"
+
+    sizes, kinds = [], []
+    for n_tiles in (0, 4, 64, 492):
+        target = bytearray(rom)
+        for tile in rng.sample(range(492), n_tiles):
+            offset = SMB1_CHR_START + 16 * tile
+            target[offset : offset + 16] = bytes(rng.randrange(4) for _ in range(16))
+        path.write_bytes(target)
+
+        mod = _smb1_graphics_mod(path, rom)
+        assert _prepare_clock_rom(rom, mod) == target
+        sizes.append(len(mod))
+        kinds.append(bytes(mod[:4]))
+
+    assert sizes[0] == len(b"PATCHEOF")
+    assert kinds[1] == b"PATC"
+    assert kinds[2] == SMB1_CHR_XOR_HEADER
+    assert kinds[3][0] == 0  # Raw LZMA
+    assert sizes == sorted(sizes)
+    assert sizes[-1] < SMB1_CHR_END - SMB1_CHR_START
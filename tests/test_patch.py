@@ -0,0 +1,92 @@
+import pytest
+
+from patches.firmware import Firmware
+from patches.intervals import Conflict, IntervalIndex, WriteLog
+
+
+class _Firmware(Firmware):
+    FLASH_BASE = 0x0800_0000
+    FLASH_LEN = 0x2_0000
+
+    symbols = {"foo": 0x0800_1235}
+
+    def address(self, name):
+        return self.symbols[name]
+
+
+def test_b_range():
+    firmware = _Firmware()
+    assert firmware.b(0x1000, 0x1004 + 2046) == 2
+    assert firmware[0x1000:0x1002] == b"\xff\xe3"
+    assert firmware.b(0x1000, 0x1004 - 2048) == 2
+    assert firmware[0x1000:0x1002] == b"\x00\xe4"
+    with pytest.raises(ValueError):
+        firmware.b(0x1000, 0x1004 + 2048)
+    with pytest.raises(ValueError):
+        firmware.b(0x1000, 0x1004 - 2050)
+
+
+def test_nop_many():
+    firmware = _Firmware()
+    assert firmware.nop_many([0x10, 0x20], 2) == 8
+    assert firmware[0x10:0x14] == firmware[0x20:0x24] == b"\x00\xbf" * 2
+    firmware.extend(b"\x00")  # Buffer is resizable again
+
+
+@pytest.mark.parametrize("index_cls", [IntervalIndex, WriteLog])
+def test_interval_index(index_cls):
+    index = index_cls()
+    index.add(0x10, 0x20, "a")
+    for i in range(0x20, 0x24):
+        index.add(i, i + 1, "a")
+    assert list(index) == [(0x10, 0x24, "a")]
+
+    index.add(0x18, 0x1C, "b")
+    assert index.conflicts == [Conflict(0x18, 0x1C, "a", "b")]
+    assert [index.owner(x) for x in (0x0F, 0x10, 0x18, 0x1C, 0x24)] == [
+        None,
+        "a",
+        "b",
+        "a",
+        None,
+    ]
+
+    index.remove(0x12, 0x1A)
+    assert list(index) == [(0x10, 0x12, "a"), (0x1A, 0x1C, "b"), (0x1C, 0x24, "a")]
+    index.add(0x14, 0x16, "c")  # Released bytes aren't a conflict
+    assert len(index.conflicts) == 1
+
+    index.truncate(0x1B)
+    assert index.overlapping(0, 0x100) == [
+        (0x10, 0x12, "a"),
+        (0x14, 0x16, "c"),
+        (0x1A, 0x1B, "b"),
+    ]
+
+
+def test_write_log_conflicts_in_time_order():
+    log = WriteLog()
+    log.add(0x10, 0x20, "a")
+    log.add(0x18, 0x28, "b")
+    log.add(0x10, 0x30, "a")
+    assert log.conflicts == [
+        Conflict(0x18, 0x20, "a", "b"),
+        Conflict(0x18, 0x28, "b", "a"),
+    ]
+    assert list(log) == [(0x10, 0x30, "a")]
+
+
+def test_firmware_records_writes():
+    firmware = _Firmware()
+    firmware.patch_index = WriteLog()
+    firmware.patch_index.origin = "relocation"
+    firmware.replace(0x100, b"\x01\x02\x03\x04")
+    firmware.move(0x100, 0x10, 4)
+    firmware.patch_index.origin = "hook"
+    firmware.bl(0x200, "foo")
+    firmware.patch_index.origin = "fix"
+    firmware.asm(0x202, "mov r0, r5")  # conflicts with the bl
+    owners = [firmware.patch_index.owner(x) for x in (0x100, 0x110, 0x200, 0x202)]
+    assert owners == [None, "relocation", "hook", "fix"]
+    assert firmware.patch_index.conflicts == [Conflict(0x202, 0x204, "hook", "fix")]
+    assert len(firmware.patch_index) == 5
@@ -0,0 +1,5 @@
+from scripts.bench_startup import heavy_imports
+
+
+def test_no_heavy_imports():
+    assert heavy_imports() == []
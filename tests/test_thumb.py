@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from patches.exception import UnsupportedAsmError
+from patches.thumb import _invert_condition, assemble, modified_immediate_table
+
+# Encodings produced by keystone (see patches/keystone_cache.json)
+KNOWN = [
+    (("add.w r2,r1,#0x10",), [1, 241, 16, 2]),
+    (("b 0x1c",), [12, 224]),
+    (("b.w #0x801b504", 134280240), [12, 240, 104, 184]),
+    (
+        ("ite ne; movne.w r4, #0xd2000; moveq.w r4, #0xd1000",),
+        [20, 191, 79, 244, 82, 36, 79, 244, 81, 36],
+    ),
+    (("mov   r0,r5",), [40, 70]),
+    (("mov r7,r0",), [7, 70]),
+    (("mov.w r1, #0x00000",), [79, 240, 0, 1]),
+    (("mov.w r2, #45056",), [79, 244, 48, 66]),
+    (("sub   sp,#0x10",), [132, 176]),
+    (("sub.w r1,r8,#0x10",), [168, 241, 16, 1]),
+]
+
+
+@pytest.mark.parametrize("args, expected", KNOWN)
+def test_known(args, expected):
+    assert assemble(*args) == expected
+
+
+@pytest.mark.parametrize(
+    "string",
+    [
+        "bl 0x100",
+        "movs r0, #1",
+        "mov.w r0, #0x1234",  # not a modified immediate
+        "movne.w r0, #1",  # outside of IT block
+        "ite ne; movne.w r4, #1",  # incomplete IT block
+        "ldr r0, [pc, #4]",
+    ],
+)
+def test_unsupported(string):
+    with pytest.raises(UnsupportedAsmError):
+        assemble(string)
+
+
+def _corpus():
+    rng = random.Random(0)
+    regs = [f"r{i}" for i in range(13)] + ["lr", "sp", "pc", "ip"]
+    imms = list(modified_immediate_table())[::37]
+    imms += [rng.randrange(1 << 32) for _ in range(50)]
+
+    for imm in imms:
+        r1, r2 = rng.choice(regs), rng.choice(regs)
+        yield f"mov.w {r1}, #{imm:#x}", 0
+        yield f"cmp.w {r1}, #{imm}", 0
+        yield f"add.w {r1}, {r2}, #{imm:#x}", 0
+        yield f"sub.w {r1},{r2},#{imm}", 0
+    for _ in range(100):
+        yield f"movw {rng.choice(regs)}, #{rng.randrange(1 << 16)}", 0
+        yield f"mov {rng.choice(regs)}, {rng.choice(regs)}", 0
+    for imm in range(0, 512, 12):
+        yield f"sub sp, #{imm}", 0
+        yield f"add sp, #{imm}", 0
+    for cond in ["eq", "ne", "hs", "lo", "mi", "ge", "lt", "gt", "le", "hi", "ls"]:
+        for suffix in ["", "t", "e", "te", "et", "tee"]:
+            conds = [cond] + [
+                cond if x == "t" else _invert_condition(cond) for x in suffix
+            ]
+            body = "; ".join(f"mov{c}.w r{i}, #{i * 16}" for i, c in enumerate(conds))
+            yield f"it{suffix} {cond}; {body}", 0
+    for _ in range(500):
+        addr = rng.randrange(0x0800_0000, 0x0804_0000) & ~1
+        offset = rng.choice(
+            [rng.randrange(-3000, 3000), rng.randrange(-(1 << 25), 1 << 25)]
+        )
+        yield f"b.w #{addr + offset:#x}", addr
+        yield f"b {addr + offset:#x}", addr
+
+
+def test_keystone_cross_check():
+    keystone = pytest.importorskip("keystone")
+    ks = keystone.Ks(keystone.KS_ARCH_ARM, keystone.KS_MODE_THUMB)
+
+    n_supported = 0
+    for string, addr in _corpus():
+        try:
+            encoding = assemble(string, addr)
+        except UnsupportedAsmError:
+            continue
+        n_supported += 1
+        assert encoding == ks.asm(string, addr)[0], (string, hex(addr))
+    assert n_supported > 500
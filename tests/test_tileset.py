@@ -1,8 +1,25 @@
 import random
+import struct
+from io import BytesIO
 
 import numpy as np
+import pytest
+from PIL import Image
 
-from patches.tileset import bytes_to_tilemap, tilemap_to_bytes
+from patches.tileset import (
+    backdrop_size,
+    bytes_to_canvas,
+    bytes_to_tilemap,
+    decode_backdrop,
+    decode_backdrops,
+    lzw_encode,
+    pack_pixels,
+    recompress_backdrop,
+    render_palettes,
+    rgb_to_index,
+    tilemap_to_bytes,
+    unpack_pixels,
+)
 
 
 def test_tileset_auto():
@@ -13,3 +30,196 @@ def test_tileset_auto():
     new_data = tilemap_to_bytes(img, palette)
 
     assert data == new_data
+
+
+def test_tileset_partial_last_row():
+    # 5 tiles on a 3 tile wide canvas; the 6th tile is zero padding.
+    data = np.random.randint(0, 80, 5 * 256, dtype=np.uint8).tobytes()
+
+    canvas = np.array(bytes_to_tilemap(data, width=48))
+    assert canvas.shape == (32, 48)
+
+    tiles = np.frombuffer(data, dtype=np.uint8).reshape(5, 16, 16)
+    assert (canvas[:16, 16:32] == tiles[1]).all()
+    assert (canvas[16:, 16:32] == tiles[4]).all()
+    assert (canvas[16:, 32:] == 0).all()
+
+    assert tilemap_to_bytes(canvas) == data + bytes(256)
+
+
+@pytest.mark.parametrize("bpp", [1, 2, 4, 8])
+def test_pack_unpack_pixels(bpp):
+    rng = np.random.default_rng(bpp)
+    for n in (0, 1, 7, 64):
+        data = rng.integers(0, 256, n, dtype=np.uint8).tobytes()
+        pixels = unpack_pixels(data, bpp)
+        assert len(pixels) == n * 8 // bpp
+        assert pixels.max(initial=0) < 1 << bpp
+        assert pack_pixels(pixels, bpp) == data
+
+    # MSB first; high bits are ignored when packing.
+    pixels = np.arange(8 // bpp, dtype=np.uint8) | (0xFF << bpp & 0xFF)
+    expected = sum(
+        (i & ((1 << bpp) - 1)) << (8 - bpp * (i + 1)) for i in range(8 // bpp)
+    )
+    assert pack_pixels(pixels, bpp) == bytes([expected])
+
+
+@pytest.mark.parametrize("bpp", [1, 2, 4])
+def test_tileset_sub_byte_roundtrip(bpp):
+    data = random.randbytes(2 * 16 * 256 * bpp // 8)
+    palette = random.randbytes(80 * 4)
+
+    img = bytes_to_tilemap(data, palette, bpp=bpp)
+    assert img.size == (256, 32)
+    assert tilemap_to_bytes(img, palette, bpp=bpp) == data
+
+
+def test_pack_pixels_invalid():
+    with pytest.raises(ValueError):
+        pack_pixels(np.zeros(3, dtype=np.uint8), 4)
+    with pytest.raises(ValueError):
+        unpack_pixels(b"\x00", 3)
+
+
+def test_rgb_to_index_nearest():
+    rng = np.random.default_rng(0)
+    palette = rng.integers(0, 256, 320, dtype=np.uint8).tobytes()
+    image = rng.integers(0, 256, (40, 50, 3), dtype=np.uint8)
+
+    p = np.frombuffer(palette, dtype=np.uint8).reshape(80, 4)[:, 2::-1]
+    dist = ((image[..., None, :].astype(int) - p.astype(int)) ** 2).sum(axis=-1)
+    expected = dist.argmin(axis=-1)
+
+    assert (rgb_to_index(image, palette) == expected).all()
+    # Second conversion is served from the per-palette cache
+    assert (rgb_to_index(image[::-1], palette) == expected[::-1]).all()
+
+
+def test_rgb_to_index_no_wraparound():
+    palette = bytearray(b"\x80\x80\x80\x00" * 80)  # Gray
+    palette[0:3] = b"\xff\xff\xff"  # White
+    palette[4:7] = b"\x20\x20\x20"  # Dark gray
+    image = np.zeros((1, 1, 3), dtype=np.uint8)  # Black
+    assert rgb_to_index(image, bytes(palette))[0, 0] == 1
+
+
+def test_render_palettes():
+    data = random.randbytes(3 * 256)
+    palettes = [random.randbytes(80 * 4) for _ in range(5)]
+
+    images = render_palettes(bytes_to_canvas(data, bpp=4, width=32), palettes)
+    assert images.shape == (5, 48, 32, 3)  # 6 tiles, 2 per row
+    for image, palette in zip(images, palettes):
+        expected = bytes_to_tilemap(data, palette, bpp=4, width=32).convert("RGB")
+        assert (image == np.array(expected)).all()
+
+
+def _make_backdrop(indices, palette):
+    """Backdrop with the LZW stream of a PIL encoded GIF."""
+    im = Image.fromarray(indices, "P")
+    im.putpalette([0] * 768)
+    f = BytesIO()
+    im.save(f, "GIF", optimize=False, interlace=False)
+    gif = f.getvalue()
+
+    idx = 13 + (3 * (2 << (gif[10] & 7)) if gif[10] & 0x80 else 0)
+    while gif[idx] == 0x21:  # Extensions
+        idx += 2
+        while gif[idx]:
+            idx += 1 + gif[idx]
+        idx += 1
+    assert gif[idx] == 0x2C and not gif[idx + 9] & 0x80
+    start = idx = idx + 10
+    idx += 1
+    while gif[idx]:
+        idx += 1 + gif[idx]
+    idx += 1
+
+    h, w = indices.shape
+    return (
+        struct.pack("<HHBx", w, h, len(palette))
+        + np.asarray(palette, dtype="<u2").tobytes()
+        + gif[start:idx]
+        + b"\x3b"
+    )
+
+
+def test_decode_backdrop():
+    rng = np.random.default_rng(0)
+    indices = rng.integers(0, 5, (60, 80), dtype=np.uint8)
+    palette = [0x0000, 0xFFFF, 0xF800, 0x07E0, 0x001F]
+    backdrop = _make_backdrop(indices, palette)
+
+    data = b"\xAA" * 3 + backdrop + b"\xAA" * 3
+    assert backdrop_size(data[3:]) == len(backdrop)
+
+    im, size = decode_backdrop(data[3:])
+    assert size == len(backdrop)
+    assert (np.array(im) == indices).all()
+    rgb = np.array(im.convert("RGB"))
+    assert tuple(rgb[indices == 2][0]) == (255, 0, 0)
+    assert tuple(rgb[indices == 1][0]) == (255, 255, 255)
+
+    images = decode_backdrops(data + backdrop, [3, len(data)])
+    assert [(np.array(x) == indices).all() for x in images] == [True, True]
+
+
+@pytest.mark.parametrize("min_code_size", [2, 5, 8])
+def test_lzw_encode(min_code_size):
+    rng = np.random.default_rng(min_code_size)
+    indices = rng.integers(0, 1 << min_code_size, (64, 300), dtype=np.uint8)
+    indices[32:] = indices[32]  # Long runs
+
+    lzw = lzw_encode(indices.ravel().tolist(), min_code_size)
+    blocks = b"".join(
+        bytes([len(lzw[i : i + 255])]) + lzw[i : i + 255]
+        for i in range(0, len(lzw), 255)
+    )
+    gif = (
+        struct.pack("<6sHHBBB", b"GIF89a", 300, 64, 0x87, 0, 0)
+        + bytes(768)
+        + struct.pack("<BHHHHBB", 0x2C, 0, 0, 300, 64, 0, min_code_size)
+        + blocks
+        + b"\x00\x3b"
+    )
+    assert (np.array(Image.open(BytesIO(gif))) == indices).all()
+
+
+def _uncompressed_lzw(pixels, min_code_size):
+    """Valid LZW stream that spends one code per pixel."""
+    code_size = min_code_size + 1
+    codes = []
+    for i, pixel in enumerate(pixels):
+        if i % ((1 << min_code_size) - 2) == 0:
+            codes.append(1 << min_code_size)
+        codes.append(pixel)
+    codes.append((1 << min_code_size) + 1)
+
+    acc = sum(code << (i * code_size) for i, code in enumerate(codes))
+    lzw = acc.to_bytes(-(-len(codes) * code_size // 8), "little")
+    return b"".join(
+        bytes([len(lzw[i : i + 255])]) + lzw[i : i + 255]
+        for i in range(0, len(lzw), 255)
+    )
+
+
+def test_recompress_backdrop():
+    rng = np.random.default_rng(0)
+    indices = rng.integers(0, 5, (60, 80), dtype=np.uint8)
+    indices[30:] = indices[30]  # Long runs
+    header = struct.pack("<HHBx", 80, 60, 5) + np.arange(5, dtype="<u2").tobytes()
+    backdrop = (
+        header + b"\x03" + _uncompressed_lzw(indices.ravel().tolist(), 3) + b"\x00\x3b"
+    )
+    assert (np.array(decode_backdrop(backdrop)[0]) == indices).all()
+
+    new = recompress_backdrop(backdrop + b"\x00" * 10)
+    assert len(new) < len(backdrop)
+    assert backdrop_size(new) == len(new)
+    # Header, palette and minimum code size are untouched.
+    assert new[: len(header) + 1] == backdrop[: len(header) + 1]
+    assert (np.array(decode_backdrop(new)[0]) == indices).all()
+
+    # Nothing to gain: the original is returned.
+    assert recompress_backdrop(new) == new
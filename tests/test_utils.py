@@ -0,0 +1,30 @@
+import random
+
+from patches.utils import fds_crc, fds_crcs
+
+
+def _fds_crc_bitwise(data, checksum=0x8000):
+    for byte in bytes(data) + b"\x00\x00":
+        for bit_index in range(8):
+            bit = (byte >> bit_index) & 0x1
+            carry = checksum & 0x1
+            checksum = (checksum >> 1) | (bit << 15)
+            if carry:
+                checksum ^= 0x8408
+    return checksum.to_bytes(2, "little")
+
+
+def test_fds_crc():
+    rng = random.Random(0)
+    for size in (0, 1, 2, 0x10, 0x38, 1000):
+        data = rng.randbytes(size)
+        assert fds_crc(data) == _fds_crc_bitwise(data)
+        assert fds_crc(data, 0) == _fds_crc_bitwise(data, 0)
+        assert fds_crc(bytearray(data)) == fds_crc(memoryview(data))
+
+
+def test_fds_crcs():
+    rng = random.Random(1)
+    blocks = [rng.randbytes(rng.randrange(100)) for _ in range(20)]
+    assert fds_crcs(blocks) == [_fds_crc_bitwise(x) for x in blocks]
+    assert fds_crcs([]) == []